@@ -0,0 +1,399 @@
+"""Benchmark wright against a stub compiler and synthetic configurations.
+
+The stub compiler has a configurable latency and fails on every command
+line or source that contains "missing", so the time spent in wright itself
+can be measured separately from the compiler. Every scenario runs wright in
+a fresh process:
+
+    cold     without a cache
+    warm     with the cache of the cold run
+    partial  after a change to the c:header section
+    snapshot with the snapshot of an earlier run, nothing changed
+
+The other scenarios run with --no-snapshot, so they measure the checks.
+
+Example::
+
+    python -m wright.bench --checks 1000 --save baseline.json
+    python -m wright.bench --checks 1000 --compare baseline.json
+"""
+from __future__ import print_function
+
+import argparse
+import atexit
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+from . import trace
+
+SCENARIOS = ('cold', 'warm', 'partial', 'snapshot')
+# Reported phases, with the trace span categories and names they consist of
+PHASES = (
+    ('config', ('config', None)),
+    ('cache load', ('cache', 'load')),
+    ('cache save', ('cache', 'save')),
+    ('checks', ('stage', None)),
+    ('processes', ('exec', None)),
+    ('generate', ('generate', None)),
+)
+
+STUB = r'''#!{python}
+import os
+import re
+import sys
+import time
+
+time.sleep(float(os.environ.get('WRIGHT_STUB_LATENCY', '0')))
+args = sys.argv[1:]
+source = sys.stdin.read() if '-' in args else ''
+for arg in args:
+    # Included and precompiled headers
+    if arg.endswith('.h') and os.path.isfile(arg):
+        with open(arg) as fp:
+            source += fp.read()
+fail = re.compile(os.environ.get('WRIGHT_STUB_FAIL', 'missing'))
+
+if '--version' in args:
+    print('wright stub compiler 1.0')
+    sys.exit(0)
+
+if fail.search(' '.join(args) + source):
+    sys.exit(1)
+
+if '--cflags' in args or '--libs' in args:
+    names = [arg for arg in args if not arg.startswith('-')]
+    flags = []
+    for name in names:
+        if '--cflags' in args:
+            flags.append('-DHAVE_' + name.upper())
+        if '--libs' in args:
+            flags.append('-l' + name)
+    print(' '.join(flags))
+    sys.exit(0)
+
+if '-dM' in args:
+    for header in re.findall(r'#include <([^>]+)>', source):
+        print('#define DEF_%s 1' % re.sub(r'\W', '_', header).upper())
+    sys.exit(0)
+
+if '-o' in args:
+    output = args[args.index('-o') + 1]
+    if output != os.devnull:
+        with open(output, 'w') as fp:
+            fp.write('#!/bin/sh\nexit 0\n')
+        os.chmod(output, 0o755)
+'''
+
+TEMPLATE = '''{% for key, value in have()|sort %}#define {{ key }} {{ value|int }}
+{% endfor %}'''
+
+
+def split(checks, fail_ratio=0.1):
+    """Divide the number of checks over the kinds of checks."""
+    weights = (
+        ('header', 30), ('define', 15), ('type', 15), ('member', 10),
+        ('library', 10), ('feature', 5), ('set', 10), ('flags', 5),
+    )
+    counts = {}
+    for kind, weight in weights:
+        total = max(1, checks * weight // 100)
+        failed = int(total * fail_ratio)
+        counts[kind] = (total - failed, failed)
+    return counts
+
+
+def generate(directory, checks, fail_ratio=0.1, marshaler='json'):
+    """Write the stub compiler, feature sources, template and wright.ini."""
+    bindir = os.path.join(directory, 'bin')
+    os.makedirs(os.path.join(directory, 'bench'))
+    os.makedirs(bindir)
+    stub = os.path.join(bindir, 'wright-cc')
+    with open(stub, 'w') as fp:
+        fp.write(STUB.replace('{python}', sys.executable))
+    os.chmod(stub, 0o755)
+    with open(os.path.join(directory, 'bench.h.in'), 'w') as fp:
+        fp.write(TEMPLATE)
+
+    counts = split(checks, fail_ratio)
+    sections = []
+
+    def section(name, passed, failed):
+        text = '[{}]\nrequired =\n'.format(name)
+        text += ''.join('    {}\n'.format(item) for item in passed)
+        text += 'optional =\n'
+        text += ''.join('    {}\n'.format(item) for item in failed)
+        sections.append(text)
+
+    def items(kind, fmt):
+        passed, failed = counts[kind]
+        return (
+            [fmt.format(i=i, state='bench') for i in range(passed)],
+            [fmt.format(i=i, state='missing') for i in range(failed)],
+        )
+
+    section('c:header', *items('header', 'bench/{state}_{i}.h'))
+    passed, failed = items('define', 'bench/{state}_{i}.h')
+    section('c:define',
+        ['DEF_{}: {}'.format(re.sub(r'\W', '_', header).upper(), header)
+         for header in passed],
+        ['DEF_NONE_{}: {}'.format(i, header)
+         for i, header in enumerate(failed)])
+    section('c:type', *items('type', '{state}_type_{i}_t: bench/hdr.h'))
+    section('c:member', *items('member', 'struct bench_{i}.{state}: bench/hdr.h'))
+    section('c:library', *items('library', '{state}{i}: bench/hdr.h'))
+
+    passed, failed = items('feature', 'bench/{state}_feature_{i}.c')
+    for source in passed + failed:
+        with open(os.path.join(directory, source), 'w') as fp:
+            fp.write('int main() { return 0; }\n')
+    section('c:feature',
+        ['feature {}: {}'.format(i, source) for i, source in enumerate(passed)],
+        ['missing feature {}: {}'.format(i, source)
+         for i, source in enumerate(failed)])
+
+    section('env:binary', ['wright-cc: --version'], ['missing-cc: --version'])
+    section('env:set', *items('set', '{state}_{i}: value {i}'))
+    section('env:flags', *items('flags',
+        'flags {state}{i}: wright-cc --cflags {state}{i}, '
+        'wright-cc --libs {state}{i}'))
+
+    with open(os.path.join(directory, 'wright.ini'), 'w') as fp:
+        fp.write('[configure]\nstages = c, env\n\n')
+        fp.write('[cache]\nmarshaler = {}\n\n'.format(marshaler))
+        fp.write('\n'.join(sections))
+        fp.write('\n[env:generate]\nsource = {target}.in\ntarget =\n'
+                 '    bench.h\n')
+
+    return sum(passed + failed for passed, failed in counts.values()) + 2
+
+
+def invalidate(directory):
+    """Change the c:header section, so only its results are invalidated."""
+    filename = os.path.join(directory, 'wright.ini')
+    with open(filename) as fp:
+        config = fp.read()
+    config = config.replace('[c:header]\nrequired =\n',
+        '[c:header]\nrequired =\n    bench/extra_{}.h\n'.format(time.time()))
+    with open(filename, 'w') as fp:
+        fp.write(config)
+
+
+class Phases(trace.Hook):
+    """Sums the duration of trace spans, by category and name."""
+
+    def __init__(self):
+        self.totals = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self, category, name, attrs):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        self._local.stack.append(time.time())
+
+    def end(self, category, name, attrs):
+        duration = time.time() - self._local.stack.pop()
+        with self._lock:
+            for key in ((category, None), (category, name)):
+                self.totals[key] = self.totals.get(key, 0.0) + duration
+
+    def phases(self):
+        return dict(
+            (phase, self.totals.get(key, 0.0)) for phase, key in PHASES
+        )
+
+
+def peak_memory():
+    """Peak resident memory of this process, in kB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def child(result, argv):
+    """Run wright in this process, the measurements are written at exit."""
+    from .main import main
+
+    phases = Phases()
+    trace.register(phases)
+    start = time.time()
+
+    def report():
+        # Registered first, so it runs after the cache is saved
+        with open(result, 'w') as fp:
+            json.dump({
+                'wall': time.time() - start,
+                'phases': phases.phases(),
+                'memory': peak_memory(),
+            }, fp)
+
+    atexit.register(report)
+    sys.argv = ['wright'] + argv
+    return main()
+
+
+def run(directory, argv):
+    """Run wright in a new process, returns its measurements."""
+    fd, result = tempfile.mkstemp(prefix='wright-bench-', suffix='.json')
+    os.close(fd)
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PATH'] = os.pathsep.join([
+        os.path.join(directory, 'bin'), env.get('PATH', '')])
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package] + [env['PYTHONPATH']] * ('PYTHONPATH' in env))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            code = subprocess.call(
+                [sys.executable, '-m', 'wright.bench', '--child', result,
+                 '--'] + argv,
+                cwd=directory, env=env, stdout=devnull)
+        if code != 0:
+            raise RuntimeError('wright failed, see {}'.format(
+                os.path.join(directory, 'wright.log')))
+        with open(result) as fp:
+            return json.load(fp)
+    finally:
+        os.unlink(result)
+
+
+def benchmark(args):
+    directory = tempfile.mkdtemp(prefix='wright-bench-')
+    try:
+        checks = generate(directory, args.checks, args.fail_ratio,
+            args.marshaler)
+        argv = ['CC=wright-cc', '-j', str(args.jobs)]
+        if args.batch:
+            argv.append('--batch')
+        checks_argv = argv + ['--no-snapshot']
+
+        results = dict((scenario, []) for scenario in SCENARIOS)
+        for _ in range(args.runs):
+            for name in os.listdir(directory):
+                if name.startswith('wright.cache'):
+                    os.unlink(os.path.join(directory, name))
+            results['cold'].append(run(directory, checks_argv))
+            results['warm'].append(run(directory, checks_argv))
+            invalidate(directory)
+            results['partial'].append(run(directory, checks_argv))
+            # The first run takes the snapshot, the second one uses it
+            run(directory, argv)
+            results['snapshot'].append(run(directory, argv))
+    finally:
+        if args.keep:
+            print('kept benchmark in {}'.format(directory))
+        else:
+            shutil.rmtree(directory, True)
+
+    # Keep the fastest run of each scenario, it has the least noise
+    summary = {'checks': checks, 'options': argv[1:], 'scenarios': {}}
+    for scenario, runs in results.items():
+        best = min(runs, key=lambda result: result['wall'])
+        best['throughput'] = checks / best['wall']
+        summary['scenarios'][scenario] = best
+    return summary
+
+
+def show(summary):
+    print('{} checks, options: {}'.format(
+        summary['checks'], ' '.join(summary['options'])))
+    header = '{:<10}{:>10}{:>12}'.format('scenario', 'wall', 'checks/s')
+    for phase, _ in PHASES:
+        header += '{:>12}'.format(phase)
+    print(header + '{:>12}'.format('memory'))
+    for scenario in SCENARIOS:
+        result = summary['scenarios'][scenario]
+        line = '{:<10}{:>9.3f}s{:>12.1f}'.format(
+            scenario, result['wall'], result['throughput'])
+        for phase, _ in PHASES:
+            line += '{:>11.3f}s'.format(result['phases'][phase])
+        print(line + '{:>10}kB'.format(result['memory']))
+
+
+def compare(summary, baseline, tolerance):
+    """Compare with a baseline, returns the number of regressions."""
+    regressions = 0
+    if baseline['checks'] != summary['checks']:
+        print('warning: baseline has {} checks'.format(baseline['checks']))
+    for scenario in SCENARIOS:
+        if scenario not in baseline['scenarios']:
+            print('{:<10}not in baseline'.format(scenario))
+            continue
+        old = baseline['scenarios'][scenario]['wall']
+        new = summary['scenarios'][scenario]['wall']
+        change = (new - old) / old if old else 0.0
+        state = 'ok'
+        if change > tolerance:
+            state = 'REGRESSION'
+            regressions += 1
+        print('{:<10}{:>9.3f}s ->{:>9.3f}s {:>+8.1%}  {}'.format(
+            scenario, old, new, change, state))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark wright with a stub compiler')
+    parser.add_argument('--checks', default=500, type=int, metavar='<n>',
+        help='number of checks in the generated configuration (default: 500)')
+    parser.add_argument('--fail-ratio', default=0.1, type=float,
+        metavar='<ratio>', help='share of failing checks (default: 0.1)')
+    parser.add_argument('--latency', default=0.0, type=float,
+        metavar='<seconds>', help='stub compiler latency (default: 0)')
+    parser.add_argument('--marshaler', default='json',
+        choices=('json', 'pickle', 'sqlite'),
+        help='cache marshaler (default: json)')
+    parser.add_argument('-j', '--jobs', default=1, type=int, metavar='<n>',
+        help='number of checks to run concurrently (default: 1)')
+    parser.add_argument('--batch', action='store_true',
+        help='compile checks of the same kind in batches')
+    parser.add_argument('--runs', default=3, type=int, metavar='<n>',
+        help='repeat every scenario, the fastest run counts (default: 3)')
+    parser.add_argument('--save', metavar='<file>',
+        help='store the results as baseline')
+    parser.add_argument('--compare', metavar='<file>',
+        help='compare the results with a baseline')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+        metavar='<ratio>', help='allowed slowdown (default: 0.1)')
+    parser.add_argument('--keep', action='store_true',
+        help='keep the generated configuration')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('argv', nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args.child, args.argv)
+
+    os.environ['WRIGHT_STUB_LATENCY'] = str(args.latency)
+    summary = benchmark(args)
+    show(summary)
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(summary, fp, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if compare(summary, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
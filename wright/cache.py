@@ -2,22 +2,33 @@ import atexit
 import json
 import os
 import pickle
-import platform as pyplatform
 import sys
+import threading
+
+from .trace import Span
+from .util import uname
+
+# Reserved key, for the section digests, in the marshaled cache
+SECTIONS = '.sections'
+
+
+def join_key(item):
+    """Convert a (nested) cache key to a string."""
+    if isinstance(item, (tuple, list)):
+        return '-'.join(join_key(part) for part in item if part)
+    return str(item)
 
 
 class Cache(object):
     def __init__(self, platform, marshaler='json'):
         self.marshaler = marshaler or 'json'
-        # We use platform.uname here, because os.uname is not available on
-        # all supported platforms.
-        self.prefix = ':'.join([pyplatform.uname()[1], platform])
+        self.prefix = ':'.join([uname()[1], platform])
         self.cached = {}
+        # Digests of the configuration sections the cached results depend on
+        self.sections = {}
 
     def _key(self, item):
-        if isinstance(item, (tuple, list)):
-            return '-'.join(self._key(part) for part in item if part)
-        return str(item)
+        return join_key(item)
 
     def __contains__(self, item):
         try:
@@ -45,9 +56,43 @@ class Cache(object):
     def values(self):
         raise NotImplementedError()
 
-    def open(self, filename, not_before=None):
-        self.load(filename, not_before)
-        atexit.register(lambda: self.save(filename))
+    def open(self, filename):
+        with Span('cache', 'load', filename=filename):
+            self.load(filename)
+        atexit.register(self._save, filename)
+
+    def _save(self, filename):
+        with Span('cache', 'save', filename=filename):
+            self.save(filename)
+
+    def changed(self, sections):
+        """Return the stage:check sections that have changed, sorted.
+
+        The sections argument maps each section to the digest of its content.
+        """
+        known = self.sections.get(self.prefix, {})
+        return sorted(
+            section for section in set(known) | set(sections)
+            if known.get(section) != sections.get(section)
+        )
+
+    def invalidate(self, sections):
+        """Drop the results of stage:check sections that have changed."""
+        changed = self.changed(sections)
+        cached = self.cached.get(self.prefix, {})
+        for section in changed:
+            start = self._key(section.split(':', 1)) + '-'
+            for key in [key for key in cached if key.startswith(start)]:
+                del cached[key]
+
+        self.sections[self.prefix] = dict(sections)
+        return changed
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
     def pop(self, key, default=None):
         try:
@@ -57,34 +102,165 @@ class Cache(object):
             value = default
         return value
 
-    def load(self, filename, not_before=None):
+    def load(self, filename):
         sys.stdout.write('loading cache from {}... '.format(filename))
         if not os.path.isfile(filename):
             sys.stdout.write('skipped (not found)\n')
             return
-        if not_before is not None:
-            cache_time = os.stat(filename).st_mtime
-            if cache_time < not_before:
-                sys.stdout.write('skipped (config is more recent than cache)\n')
-                return
 
         with open(filename, 'rb') as fp:
             if self.marshaler == 'json':
-                self.cached.update(json.load(fp))
+                cached = json.load(fp)
             elif self.marshaler == 'pickle':
-                self.cached.update(pickle.load(fp))
+                cached = pickle.load(fp)
             else:
                 raise TypeError('Marshaler "{}" not supported'.format(
                     self.marshaler))
 
+        self.sections.update(cached.pop(SECTIONS, {}))
+        self.cached.update(cached)
         sys.stdout.write('ok\n')
 
     def save(self, filename):
+        cached = dict(self.cached)
+        cached[SECTIONS] = self.sections
         with open(filename, 'wb') as fp:
             if self.marshaler == 'json':
-                json.dump(self.cached, fp, indent=2, sort_keys=True)
+                json.dump(cached, fp, indent=2, sort_keys=True)
             elif self.marshaler == 'pickle':
-                pickle.dump(self.cached, fp)
+                pickle.dump(cached, fp)
             else:
                 raise TypeError('Marshaler "{}" not supported'.format(
                     self.marshaler))
+
+
+class SQLiteCache(Cache):
+    """Cache backed by an SQLite database.
+
+    Results are committed as soon as they are stored and looked up per key,
+    the database runs in WAL mode so concurrent runs can share the cache.
+    """
+
+    schema = (
+        '''CREATE TABLE IF NOT EXISTS cache (
+            prefix TEXT NOT NULL,
+            key    TEXT NOT NULL,
+            value  TEXT NOT NULL,
+            PRIMARY KEY (prefix, key)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS sections (
+            prefix  TEXT NOT NULL,
+            section TEXT NOT NULL,
+            digest  TEXT NOT NULL,
+            PRIMARY KEY (prefix, section)
+        )''',
+    )
+
+    def __init__(self, platform, marshaler='sqlite'):
+        super(SQLiteCache, self).__init__(platform, marshaler)
+        self.db = None
+        self._lock = threading.Lock()
+
+    def _execute(self, query, *args):
+        with self._lock:
+            return self.db.execute(query, args).fetchall()
+
+    def __contains__(self, item):
+        return bool(self._execute(
+            'SELECT 1 FROM cache WHERE prefix = ? AND key = ?',
+            self.prefix, self._key(item)))
+
+    def __delitem__(self, item):
+        self._execute(
+            'DELETE FROM cache WHERE prefix = ? AND key = ?',
+            self.prefix, self._key(item))
+
+    def __getitem__(self, item):
+        rows = self._execute(
+            'SELECT value FROM cache WHERE prefix = ? AND key = ?',
+            self.prefix, self._key(item))
+        if not rows:
+            raise KeyError(item)
+        return json.loads(rows[0][0])
+
+    def __setitem__(self, item, value):
+        self._execute(
+            'INSERT OR REPLACE INTO cache (prefix, key, value) VALUES (?, ?, ?)',
+            self.prefix, self._key(item), json.dumps(value))
+
+    def changed(self, sections):
+        known = dict(self._execute(
+            'SELECT section, digest FROM sections WHERE prefix = ?',
+            self.prefix))
+        return sorted(
+            section for section in set(known) | set(sections)
+            if known.get(section) != sections.get(section)
+        )
+
+    def invalidate(self, sections):
+        with self._lock:
+            # Compare and update the digests in one transaction, so concurrent
+            # runs don't both invalidate the same sections.
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                known = dict(self.db.execute(
+                    'SELECT section, digest FROM sections WHERE prefix = ?',
+                    (self.prefix,)).fetchall())
+                changed = set(known) | set(sections)
+                changed = sorted(
+                    section for section in changed
+                    if known.get(section) != sections.get(section)
+                )
+                for section in changed:
+                    start = self._key(section.split(':', 1)) + '-'
+                    self.db.execute(
+                        '''DELETE FROM cache WHERE prefix = ?
+                           AND substr(key, 1, ?) = ?''',
+                        (self.prefix, len(start), start))
+                self.db.execute(
+                    'DELETE FROM sections WHERE prefix = ?', (self.prefix,))
+                self.db.executemany(
+                    '''INSERT INTO sections (prefix, section, digest)
+                       VALUES (?, ?, ?)''',
+                    [(self.prefix, section, digest)
+                     for section, digest in sections.items()])
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+
+        return changed
+
+    def open(self, filename):
+        with Span('cache', 'load', filename=filename):
+            self.load(filename, readonly=False)
+        atexit.register(self._save, filename)
+
+    def load(self, filename, readonly=True):
+        """Connect to the database, it is only created and written if the
+        cache is opened, loading it for a plan only reads it."""
+        sys.stdout.write('loading cache from {}... '.format(filename))
+        import sqlite3
+
+        found = os.path.isfile(filename)
+        if readonly and not found:
+            # Nothing is cached, an empty database stands in for it
+            filename = ':memory:'
+
+        # Autocommit mode, every stored result is committed immediately
+        self.db = sqlite3.connect(filename, timeout=30,
+            isolation_level=None, check_same_thread=False)
+        if readonly and found:
+            self.db.execute('PRAGMA query_only = ON')
+        else:
+            if not readonly:
+                self.db.execute('PRAGMA journal_mode=WAL')
+            for query in self.schema:
+                self.db.execute(query)
+        sys.stdout.write('ok\n' if found else 'skipped (not found)\n')
+
+    def save(self, filename):
+        if self.db is not None:
+            with self._lock:
+                self.db.close()
+                self.db = None
@@ -1,9 +1,78 @@
+import collections
+import json
+import re
+
 try:
     from configparser import NoSectionError, RawConfigParser
 except ImportError:
     from ConfigParser import NoSectionError, RawConfigParser
 
-from .util import parse_bool, yield_from
+from .util import digest, parse_bool, read_file, yield_from
+
+RE_SEPARATOR = re.compile(r'\s*([:,])\s*')
+
+# An item of a check, the condition is the env key it depends on, if any
+Item = collections.namedtuple('Item', 'check name args required condition')
+
+
+class Checklist(object):
+    """The items of all checks, compiled from the configuration.
+
+    Every stage maps to the items of its checks, in configuration order.
+    Platform specific options are resolved when compiling, the conditions of
+    ``required_if_<KEY>`` and ``optional_if_<KEY>`` options are evaluated
+    when the check runs. The checklist is immutable, so it can be saved and
+    used again as long as the configuration doesn't change.
+    """
+
+    version = 1
+
+    def __init__(self, source, stages, checks, digests):
+        self.source = source
+        self.stages = dict(
+            (stage, tuple(items)) for stage, items in stages.items())
+        self.checks = dict(
+            (stage, tuple(names)) for stage, names in checks.items())
+        self.digests = dict(digests)
+        self._items = {}
+        for stage, items in self.stages.items():
+            for item in items:
+                self._items.setdefault((stage, item.check), []).append(item)
+        for key, items in self._items.items():
+            self._items[key] = tuple(items)
+
+    def has_check(self, stage, check):
+        return check in self.checks.get(stage, ())
+
+    def items(self, stage, check):
+        return self._items.get((stage, check), ())
+
+    @classmethod
+    def load(cls, filename, source):
+        """Load a saved checklist, if it was compiled from the same source."""
+        try:
+            with open(filename) as fp:
+                data = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+        if data.get('version') != cls.version or data.get('source') != source:
+            return None
+        stages = dict(
+            (stage, [Item(check, name, tuple(args), required, condition)
+                for check, name, args, required, condition in items])
+            for stage, items in data['stages'].items()
+        )
+        return cls(source, stages, data['checks'], data['digests'])
+
+    def save(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump({
+                'version': self.version,
+                'source': self.source,
+                'stages': self.stages,
+                'checks': self.checks,
+                'digests': self.digests,
+            }, fp, sort_keys=True)
 
 
 class Config(RawConfigParser):
@@ -11,6 +80,8 @@ class Config(RawConfigParser):
         RawConfigParser.__init__(self)
         self.env = env
         self.platform = platform
+        self.source = None
+        self._checklist = None
 
     def add_arguments(self, parser):
         group = parser.add_argument_group('build options')
@@ -60,14 +131,49 @@ class Config(RawConfigParser):
             for line in self.get(section, option).strip().splitlines()
         ]
 
+    def digest(self, section):
+        """Digest of the section contents, ignoring whitespace and comments."""
+        options = []
+        for option in sorted(self.options(section)):
+            lines = []
+            for line in self.get(section, option).splitlines():
+                line = ' '.join(line.split())
+                if line and not line.startswith('#'):
+                    lines.append(RE_SEPARATOR.sub(r'\1', line))
+            options.append([option, lines])
+        return digest(options)
+
+    def digests(self):
+        """Digests of all stage:check sections."""
+        return dict(
+            (section, self.digest(section))
+            for section in self.sections()
+            if ':' in section
+        )
+
+    @property
+    def checklist(self):
+        if self._checklist is None:
+            self._checklist = self.compile()
+        return self._checklist
+
     def has_check(self, stage, check):
-        section = ':'.join([stage, check])
-        return self.has_section(section)
+        return self.checklist.has_check(stage, check)
+
+    def read(self, filenames):
+        found = RawConfigParser.read(self, filenames)
+        # Identifies the configuration a checklist was compiled from
+        self.source = digest(self.platform,
+            [read_file(filename) for filename in found])
+        return found
 
-    def _suboptions(self, stage, check, option):
+    def _suboptions(self, stage, check, option, includes=()):
         section = ':'.join([stage, check])
         if not self.has_option(section, option):
             return
+        if option in includes:
+            raise ValueError('include cycle in [{}]: {}'.format(
+                section, ' < '.join(includes + (option,))))
 
         for line in self.getlist(section, option):
             line = line.strip()
@@ -77,7 +183,8 @@ class Config(RawConfigParser):
             parts = [part.strip() for part in line.split(':', 1)]
             if len(parts) == 1:
                 if parts[0].startswith('<'):
-                    for nested in self._suboptions(stage, check, parts[0][1:].strip()):
+                    for nested in self._suboptions(stage, check,
+                            parts[0][1:].strip(), includes + (option,)):
                         yield nested
 
                 else:
@@ -88,9 +195,10 @@ class Config(RawConfigParser):
                     tuple([part.strip() for part in parts[1].split(',')])
                 )
 
-    def _conditional_checks(self, stage, check, kind):
-        yield kind
-        yield kind + '_' + self.platform
+    def conditions(self, stage, check, kind):
+        """Yield the options of a kind, with the env key they depend on."""
+        yield kind, None
+        yield kind + '_' + self.platform, None
         section = ':'.join([stage, check])
         for option in self.options(section):
             if option.startswith(kind + '_if_'):
@@ -100,26 +208,62 @@ class Config(RawConfigParser):
 
                     optional_if_HAVE_FOO = item, item, ...
                 """
-                condition = option[len(kind) + 4:].upper()
-                if self.env.get(condition):
-                    yield option
+                yield option, option[len(kind) + 4:].upper()
 
-    def optional(self, stage, check):
-        for key in self._conditional_checks(stage, check, 'optional'):
-            for item in self._suboptions(stage, check, key):
-                yield item
+    def compile(self):
+        """Compile the stage:check sections into a checklist."""
+        stages = {}
+        checks = {}
+        for section in self.sections():
+            if ':' not in section:
+                continue
+            stage, check = section.split(':', 1)
+            checks.setdefault(stage, []).append(check)
+            items = stages.setdefault(stage, [])
+            for kind in ('required', 'optional'):
+                for option, condition in self.conditions(stage, check, kind):
+                    for name, args in self._suboptions(stage, check, option):
+                        items.append(Item(check, name, args,
+                            kind == 'required', condition))
+        return Checklist(self.source, stages, checks, self.digests())
+
+    def load_checklist(self, filename=None, save=True):
+        """Use the checklist compiled by an earlier run, if the configuration
+        is unchanged, or compile it."""
+        checklist = Checklist.load(filename, self.source) if filename else None
+        if checklist is None:
+            checklist = self.compile()
+            if filename and save:
+                checklist.save(filename)
+        self._checklist = checklist
+        return checklist
 
+    def check_items(self, stage, check):
+        """Return the items of a check, in order, required items first."""
+        return self.checklist.items(stage, check)
+
+    def section_items(self, stage, check, required):
+        """Return the required or optional items of a check, with their
+        conditions, which are not evaluated yet."""
+        return [
+            item for item in self.check_items(stage, check)
+            if item.required == required
+        ]
+
+    def _conditional_items(self, stage, check, required):
+        for item in self.section_items(stage, check, required):
+            if item.condition is None or self.env.get(item.condition):
+                yield item.name, item.args
+
+    def optional(self, stage, check):
+        return self._conditional_items(stage, check, False)
 
     def required(self, stage, check):
-        for key in self._conditional_checks(stage, check, 'required'):
-            for item in self._suboptions(stage, check, key):
-                yield item
+        return self._conditional_items(stage, check, True)
 
     def stages(self):
         for stage in self.get('configure', 'stages').split(','):
             yield stage.strip()
 
     def stage_checks(self, stage):
-        for section in self.sections():
-            if section.startswith(stage + ':'):
-                yield section[len(stage) + 1:]
+        return self.checklist.checks.get(stage, ())
@@ -1,15 +1,40 @@
 import atexit
-import datetime
-import platform
+import json
 import sys
+import threading
+import time
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+from .util import uname
+
+# Size of the log file buffer
+BUFFER_SIZE = 1 << 16
+FORMATS = ('text', 'json')
+# With the 'failed' level, the details of successful checks are dropped
+LEVELS = ('all', 'failed')
 
 
 class Logger(object):
-    def __init__(self, filename):
+    """Log file, in text or JSON lines format.
+
+    Every line written is one record. Details, such as probe sources and
+    compiler output, are marked as such so they can be filtered.
+    """
+
+    def __init__(self, filename, fmt='text', level='all'):
         self.filename = filename
-        self.fd = open(filename, 'w')
+        self.format = fmt
+        self.level = level
+        self.profile = None
+        self.fd = open(filename, 'w', BUFFER_SIZE)
+        self._second = None
+        self._stamp = None
         atexit.register(self.close)
-        self.write('starting: on {}\n'.format(platform.uname()[3]))
+        self.write('starting: on {}\n'.format(uname()[3]))
         self.write('called as: {}\n'.format(' '.join(sys.argv)))
         self.write('python: {} version {:x}\n'.format(
             sys.executable, sys.hexversion))
@@ -17,15 +42,188 @@ class Logger(object):
     def close(self):
         self.fd.close()
 
+    def event(self, kind, **fields):
+        """Log a structured record, like the timing of a check."""
+        if self.profile is not None:
+            self.profile.add(kind, fields)
+        if self.format == 'json':
+            fields['event'] = kind
+            fields.setdefault('time', time.time())
+            self.fd.write(json.dumps(fields, sort_keys=True) + '\n')
+        else:
+            self.write('{}: {}\n'.format(kind, json.dumps(fields,
+                sort_keys=True)))
+
     def fileno(self):
         return self.fd.fileno()
 
     def flush(self):
         self.fd.flush()
 
-    def write(self, data):
-        self.writeraw(datetime.datetime.now().strftime('%FT%TZ '))
-        self.writeraw(data)
+    def stamp(self, now):
+        # Formatting the time is relatively slow, it only changes every second
+        second = int(now)
+        if second != self._second:
+            self._second = second
+            self._stamp = time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ ', time.localtime(second))
+        return self._stamp
+
+    def write(self, data, detail=False, now=None):
+        if now is None:
+            now = time.time()
+        if self.format == 'json':
+            record = {'time': now, 'message': data}
+            if detail:
+                record['detail'] = True
+            self.fd.write(json.dumps(record, sort_keys=True) + '\n')
+        else:
+            self.fd.write(self.stamp(now) + data)
+
+    def writeraw(self, data):
+        if self.format == 'json':
+            self.fd.write(json.dumps({'message': data}) + '\n')
+        else:
+            self.fd.write(data)
+
+
+class LogBuffer(object):
+    """Collects the log output of a single check.
+
+    Checks executed concurrently write to their own buffer, which is replayed
+    into the log in configuration order once the check has finished. The
+    buffer also records when the check started and ended. Sections run by
+    the scheduler collect their terminal output in the buffer as well.
+    """
+
+    def __init__(self, level='all'):
+        self.level = level
+        self.lines = []
+        self.terminal = []
+        self.start = time.time()
+        self.end = None
+        self.usage = None
+
+    def event(self, kind, **fields):
+        self.lines.append(('event', (kind,), fields))
+
+    def flush(self):
+        pass
+
+    def replay(self, log, failed=True):
+        """Write the buffer to the log, details only if the check failed."""
+        keep = failed or getattr(log, 'level', 'all') != 'failed'
+        for method, args, fields in self.lines:
+            if method == 'write' and args[1] and not keep:
+                continue
+            getattr(log, method)(*args, **fields)
+
+    def write(self, data, detail=False, now=None):
+        self.lines.append(('write', (data, detail, now or time.time()), {}))
 
     def writeraw(self, data):
-        self.fd.write(data)
+        self.lines.append(('writeraw', (data,), {}))
+
+
+class Profile(object):
+    """Collects the timing of checks and stages, for a summary at exit."""
+
+    def __init__(self, count=10):
+        self.count = count
+        self.checks = []
+        self.stages = []
+
+    def add(self, kind, fields):
+        if kind == 'check' and 'wall' in fields:
+            self.checks.append(fields)
+        elif kind == 'stage':
+            self.stages.append(fields)
+
+    def report(self, output=sys.stdout):
+        total = sum(stage['wall'] for stage in self.stages)
+        output.write('profile: {} checks in {} stages, {:.3f}s\n'.format(
+            len(self.checks), len(self.stages), total))
+
+        output.write('slowest stages:\n')
+        stages = sorted(self.stages, key=lambda stage: -stage['wall'])
+        for stage in stages[:self.count]:
+            output.write('  {:8.3f}s  {}.{}\n'.format(
+                stage['wall'], stage['stage'], stage['check']))
+
+        output.write('slowest checks:\n')
+        checks = sorted(self.checks, key=lambda check: -check['wall'])
+        for check in checks[:self.count]:
+            output.write('  {:8.3f}s  {}.{} {} ({} processes, {:.3f}s cpu)\n'.format(
+                check['wall'], check['stage'], check['check'], check['name'],
+                check['procs'], check['proc_cpu']))
+
+
+class ImportProfile(object):
+    """Measures the time spent importing modules, and the startup time.
+
+    The startup time runs from the import of wright.main until the first
+    stage runs, it should stay within the budget for runs that have nothing
+    to do.
+    """
+
+    budget = 0.05
+
+    def __init__(self, start, count=15):
+        self.start = start
+        self.count = count
+        self.imports = []
+        self.started = None
+        self.ready = None
+        self._import = None
+        self._local = threading.local()
+
+    def install(self):
+        self.started = time.time()
+        self._import = builtins.__import__
+        builtins.__import__ = self._timed
+
+    def uninstall(self):
+        builtins.__import__ = self._import
+
+    def mark(self):
+        """Mark the end of the startup, when the first stage runs."""
+        if self.ready is None:
+            self.ready = time.time()
+
+    def _timed(self, name, *args, **kwargs):
+        stack = self._local.__dict__.setdefault('stack', [])
+        modules = len(sys.modules)
+        start = time.time()
+        stack.append(0.0)
+        try:
+            return self._import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            # Only imports that loaded new modules are of interest
+            if len(sys.modules) > modules:
+                scope = args[0] if args else kwargs.get('globals')
+                level = args[3] if len(args) > 3 else kwargs.get('level', 0)
+                if level > 0 and scope:
+                    package = scope.get('__package__') or ''
+                    # Every level above one is a parent package
+                    package = package.rsplit('.', level - 1)[0]
+                    name = '.'.join(part for part in (package, name) if part)
+                self.imports.append((name, elapsed, elapsed - children))
+
+    def report(self, output=sys.stderr):
+        end = time.time()
+        ready = self.ready or end
+        output.write('startup: {:.1f}ms until the first stage, budget {:.0f}ms'
+            '{}\n'.format((ready - self.start) * 1000, self.budget * 1000,
+                ' (exceeded)' if ready - self.start > self.budget else ''))
+        output.write('  importing wright.main: {:.1f}ms\n'.format(
+            (self.started - self.start) * 1000))
+        output.write('  total run: {:.1f}ms\n'.format((end - self.start) * 1000))
+        output.write('slowest imports (self, cumulative):\n')
+        imports = sorted(self.imports, key=lambda item: -item[2])
+        for name, elapsed, own in imports[:self.count]:
+            output.write('  {:8.1f}ms {:8.1f}ms  {}\n'.format(
+                own * 1000, elapsed * 1000, name))
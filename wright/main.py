@@ -1,16 +1,57 @@
 from __future__ import print_function
 
+import sys
+import time
+
+# Start of the startup time, see --startup-profile
+START = time.time()
+
+from .log import ImportProfile
+
+# Installed before the other imports, so the cost of wright's own modules is
+# measured as well
+STARTUP = None
+if '--startup-profile' in sys.argv:
+    STARTUP = ImportProfile(START)
+    STARTUP.install()
+
 import argparse
+import atexit
+import collections
 import os
-import sys
 
+# Modules of features that are only used by some runs, like planning, probe
+# packs, snapshots, tracing and concurrent runs, are imported where they are
+# used
 from .config import Config
-from .cache import Cache
-from .log import Logger
+from .cache import Cache, SQLiteCache
+from .log import FORMATS, LEVELS, Logger, Profile
+from .trace import Span
 from .util import Environment, camel_case, detect_platform, parse_flags, import_module
 
+# Flags taken from the process environment, besides the keys the checks read
+FLAG_ENVIRON = ('ARFLAGS', 'CFLAGS', 'LDFLAGS')
+
+
+def load_stage(stage):
+    """Import the module of a stage, returns the module and stage class."""
+    if '.' in stage:
+        module = import_module(stage)
+    else:
+        module = import_module('wright.stage.{}'.format(stage))
+
+    try:
+        return module, getattr(module, camel_case(stage))
+    except AttributeError:
+        raise AttributeError('Stage {} has no class {}'.format(
+            stage, camel_case(stage)))
+
 
 def main():
+    startup = STARTUP
+    if startup is not None:
+        atexit.register(startup.report)
+
     platform = detect_platform()
 
     parser = argparse.ArgumentParser(
@@ -21,12 +62,42 @@ def main():
     group = parser.add_argument_group('wright options')
     group.add_argument('--help-options', action='store_true',
         help='show build options')
+    group.add_argument('--batch', action='store_true',
+        help='compile checks of the same kind in batches')
     group.add_argument('--cache', default='wright.cache', metavar='<file>',
         help='write configuration cache (default: wright.cache)')
     group.add_argument('--config', default='wright.ini', metavar='<file>',
         help='wright configuration (default: wright.ini)')
+    group.add_argument('--export-probes', metavar='<file>',
+        help='export the portable check results to a probe pack')
+    group.add_argument('--import-probes', metavar='<file>',
+        help='resolve checks from a probe pack')
+    group.add_argument('-j', '--jobs', default=1, type=int, metavar='<n>',
+        help='number of checks to run concurrently (default: 1)')
+    group.add_argument('--no-snapshot', action='store_true',
+        help='run all stages, even if nothing changed since the last run')
+    group.add_argument('--recheck-failed', action='store_true',
+        help='run optional checks again that failed before')
+    group.add_argument('--keep-probes', action='store_true',
+        help='keep the artifacts of failed checks')
     group.add_argument('--log', default='wright.log', metavar='<file>',
         help='wright log file (default: wright.log)')
+    group.add_argument('--log-format', default='text', choices=FORMATS,
+        help='log file format (default: text)')
+    group.add_argument('--log-level', default='all', choices=LEVELS,
+        help='log the probe sources and output of all checks, or only of '
+             'failed checks (default: all)')
+    group.add_argument('--plan', action='store_true',
+        help='show the checks that would run, without running them; exits '
+             'with 2 if any check is pending')
+    group.add_argument('--plan-json', metavar='<file>',
+        help='write the plan as JSON, implies --plan')
+    group.add_argument('--profile', action='store_true',
+        help='show the slowest checks and stages at exit')
+    group.add_argument('--startup-profile', action='store_true',
+        help='show the startup and import times at exit')
+    group.add_argument('--trace', metavar='<file>',
+        help='write a trace of the run, in Chrome trace event format')
     group.add_argument('--platform', default=platform, metavar='<name>',
         help='target platform (default: {})'.format(platform))
     # Cross compiling options
@@ -43,6 +114,28 @@ def main():
     # configuration file.
     args, remaining_args = parser.parse_known_args()
 
+    # Skip the run if none of its inputs changed since the last run
+    snapshot = None
+    if args.cache and not (args.no_snapshot or args.help_options
+            or args.plan or args.plan_json or args.export_probes
+            or set(remaining_args) & set(['-h', '--help'])):
+        from .snapshot import Snapshot
+
+        snapshot = Snapshot(args.cache + '.snapshot', args.cache)
+        sys.stdout.write('loading snapshot from {}... '.format(
+            snapshot.filename))
+        if snapshot.matches(sys.argv[1:]):
+            sys.stdout.write('ok (nothing changed)\n')
+            log = Logger(args.log, args.log_format, args.log_level)
+            log.write('snapshot: restored from {}\n'.format(
+                snapshot.filename))
+            env = snapshot.env()
+            for key in sorted(env):
+                if key.startswith('HAVE_') or key.startswith('WITH_'):
+                    log.write('env: {}={}\n'.format(key, env[key]))
+            return 0
+        sys.stdout.write('changed\n')
+
     env = Environment(args.platform)
     env.update(os.environ)
     for item in args.env:
@@ -51,7 +144,7 @@ def main():
             env[item] = ''
         else:
             env[part[0]] = part[1]
-    for key in ('ARFLAGS', 'CFLAGS', 'LDFLAGS'):
+    for key in FLAG_ENVIRON:
         env.merge(parse_flags(os.environ.get(key, ''), origin=key))
 
     if args.cross_compile:
@@ -63,67 +156,185 @@ def main():
         env['PLATFORM_' + args.platform.upper()] = True
 
     config = Config(env, args.platform)
-    if not config.read(args.config):
+    with Span('config', 'read', filename=args.config):
+        found = config.read(args.config)
+    if not found:
         print('unable to parse configuration file {}'.format(args.config))
         return 1
 
-    # Check our configuration file mtime
-    config_time = os.stat(args.config).st_mtime
-
-    # Now is a good time to parse the rest of the arguments
-    options_parser = argparse.ArgumentParser(parents=[parser])
-    options_parser.set_defaults(**args.__dict__)
+    # Now is a good time to parse the rest of the arguments, only the build
+    # options from the configuration are left
+    options_parser = argparse.ArgumentParser(add_help=False)
     config.add_arguments(options_parser)
-    args = options_parser.parse_args(remaining_args)
-
-    if args.help_options:
-        options_parser.print_help()
+    if args.help_options or set(remaining_args) & set(['-h', '--help']):
+        help_parser = argparse.ArgumentParser(
+            parents=[parser, options_parser])
+        help_parser.print_help()
         return 0
+    args = options_parser.parse_args(remaining_args, namespace=args)
 
     # Feed back the build options to our environment
     for key, value in args.__dict__.items():
         env[key.upper()] = value
 
-    log = Logger(args.log)
-    if config.getboolean('cache', 'enabled', True) and args.cache:
+    if args.trace:
+        from .trace import ChromeTrace, register
+
+        trace = ChromeTrace(args.trace)
+        register(trace)
+        atexit.register(trace.save)
+
+    planning = args.plan or args.plan_json
+    # The plan is resolved against the environment of a normal run
+    env['PLAN'] = False
+    env['PLAN_JSON'] = None
+    # A plan doesn't overwrite the log of the last run
+    log = Logger(os.devnull if planning else args.log, args.log_format,
+        args.log_level)
+    if args.profile:
+        log.profile = Profile()
+        atexit.register(log.profile.report)
+    use_cache = config.getboolean('cache', 'enabled', True) and args.cache
+    # The checklist compiled from the configuration is kept next to the cache
+    try:
+        with Span('config', 'compile'):
+            config.load_checklist(use_cache and args.cache + '.checks',
+                save=not planning)
+    except ValueError as error:
+        print('invalid configuration file {}: {}'.format(args.config, error))
+        return 1
+    if use_cache:
         marshaler = config.get('cache', 'marshaler', 'json')
         log.write('cache: {} from {}\n'.format(marshaler, args.cache))
-        cache = Cache(args.platform, marshaler=marshaler)
-        cache.open(args.cache, not_before=config_time)
+        if marshaler == 'sqlite':
+            cache = SQLiteCache(args.platform, marshaler=marshaler)
+        else:
+            cache = Cache(args.platform, marshaler=marshaler)
+        if planning:
+            # Read only, changed sections are ignored instead of invalidated
+            cache.load(args.cache)
+            changed = cache.changed(config.checklist.digests)
+        else:
+            cache.open(args.cache)
+            changed = ()
+            for section in cache.invalidate(config.checklist.digests):
+                log.write('cache: invalidated {}\n'.format(section))
     else:
         cache = dict()
+        changed = ()
+
+    if args.import_probes or args.export_probes:
+        from .pack import ProbeCache
+
+        cache = ProbeCache(cache, args.platform)
+        if args.import_probes:
+            log.write('probes: import from {}\n'.format(args.import_probes))
+            cache.load(args.import_probes)
+        if args.export_probes and not planning:
+            log.write('probes: export to {}\n'.format(args.export_probes))
+            atexit.register(lambda: cache.save(args.export_probes))
+
+    # Without a shared pool, every stage runs its checks one at a time
+    pool = None
+    if args.jobs > 1:
+        from .pool import Pool
 
-    stages = {}
+        pool = Pool(args.jobs)
+        atexit.register(pool.shutdown)
+    # The scratch directory is shared by all stages, created with the first
+    scratch = []
+    stages = collections.OrderedDict()
     for stage in config.stages():
-        if '.' in stage:
-            module = stage
-        else:
-            module = 'wright.stage.{}'.format(stage)
-
-        stages[stage] = import_module(module)
-        log.write('loaded stage {}: {}\n'.format(stage, stages[stage].__file__))
-        try:
-            stages[stage] = getattr(stages[stage], camel_case(stage))
-        except AttributeError:
-            raise AttributeError('Stage {} has no class {}'.format(
-                stage, camel_case(stage)))
-        else:
-            # Create instance of the stage (once)
-            stages[stage] = stages[stage](config, cache, env, log)
-
-    for name, stage in stages.items():
-        log.write('executing stage: {}\n'.format(name))
-        for check in stage.checks():
-            log.write('executing stage: {}, check: {}\n'.format(name, check))
-            if not stage.run(check):
-                print('wright failed, check {} for more details'.format(
-                    args.log))
-                return 1
+        stages[stage] = None
+
+    def instances():
+        """Yield the stages in order, their modules are imported on demand.
+
+        Stages without any sections in the configuration are skipped.
+        """
+        for name in stages:
+            if stages[name] is None:
+                if not config.stage_checks(name):
+                    continue
+                module, stage_class = load_stage(name)
+                log.write('loaded stage {}: {}\n'.format(name, module.__file__))
+                if not scratch:
+                    from .stage.base import Scratch
+
+                    scratch.append(Scratch(keep=args.keep_probes))
+                # Create instance of the stage (once)
+                stages[name] = stage_class(config, cache, env, log, pool=pool,
+                    scratch=scratch[0])
+            yield name, stages[name]
+
+    if startup is not None:
+        startup.mark()
+
+    if planning:
+        from .plan import Plan
+
+        plan = Plan()
+        for name, stage in instances():
+            for check in stage.checks():
+                plan.add(stage.plan(check, changed))
+        if args.plan_json:
+            plan.save(args.plan_json)
+        if args.plan:
+            plan.show()
+        summary = plan.summary()
+        return 2 if summary['pending'] or summary['error'] else 0
+
+    if args.jobs > 1:
+        from .schedule import Scheduler
+
+        # Independent sections of all stages run at the same time
+        scheduler = Scheduler(log, args.jobs)
+        for name, stage in instances():
+            for check in stage.checks():
+                scheduler.add(name, stage, check)
+        if scheduler.run() is not None:
+            print('wright failed, check {} for more details'.format(args.log))
+            return 1
+    else:
+        for name, stage in instances():
+            log.write('executing stage: {}\n'.format(name))
+            for check in stage.checks():
+                log.write('executing stage: {}, check: {}\n'.format(
+                    name, check))
+                start = time.time()
+                result = stage.run(check)
+                end = time.time()
+                log.event('stage', stage=name, check=check, start=start,
+                    end=end, wall=end - start, result=result)
+                if not result:
+                    print('wright failed, check {} for more details'.format(
+                        args.log))
+                    return 1
 
     for key in sorted(env):
         if key.startswith('HAVE_') or key.startswith('WITH_'):
             log.write('env: {}={}\n'.format(key, env[key]))
 
+    if snapshot is not None:
+        if not use_cache:
+            # Without a cache, there is no snapshot either
+            snapshot.remove()
+        else:
+            inputs = [args.config]
+            outputs = []
+            environ = set(FLAG_ENVIRON)
+            for name, stage in instances():
+                for check in stage.checks():
+                    inputs.extend(stage.inputs(check))
+                    outputs.extend(stage.outputs(check))
+                    keys = stage.environ(check)
+                    if keys is None or environ is None:
+                        environ = None
+                    else:
+                        environ.update(keys)
+            snapshot.save(sys.argv[1:], env, inputs, outputs, environ)
+            log.write('snapshot: saved to {}\n'.format(snapshot.filename))
+
     return 0
 
 
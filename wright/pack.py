@@ -0,0 +1,86 @@
+import json
+import os
+import sys
+
+from .cache import join_key
+
+
+class ProbeCache(object):
+    """Cache layer that resolves checks from a portable probe pack.
+
+    Only the results of checks with a fingerprint are portable, their cache
+    keys are (stage, check, name, args, digest) and the digest covers the
+    toolchain identity and everything else that affects the result, so the
+    keys in a pack can be used on any host and in any checkout.
+    """
+
+    version = 1
+
+    def __init__(self, cache, platform):
+        self.cache = cache
+        self.platform = platform
+        self.imported = {}
+        self.exported = {}
+
+    def _export(self, item, value):
+        if self.portable(item):
+            self.exported[join_key(item)] = value
+
+    def __contains__(self, item):
+        if item in self.cache:
+            return True
+        return self.portable(item) and join_key(item) in self.imported
+
+    def __delitem__(self, item):
+        del self.cache[item]
+
+    def __getitem__(self, item):
+        if item in self.cache:
+            value = self.cache[item]
+        elif self.portable(item):
+            value = self.imported[join_key(item)]
+        else:
+            raise KeyError(item)
+        self._export(item, value)
+        return value
+
+    def __setitem__(self, item, value):
+        self.cache[item] = value
+        self._export(item, value)
+
+    def get(self, item, default=None):
+        try:
+            return self[item]
+        except KeyError:
+            return default
+
+    def pop(self, item, default=None):
+        return self.cache.pop(item, default)
+
+    def portable(self, item):
+        return isinstance(item, tuple) and len(item) == 5
+
+    def load(self, filename):
+        sys.stdout.write('loading probes from {}... '.format(filename))
+        if not os.path.isfile(filename):
+            sys.stdout.write('skipped (not found)\n')
+            return
+
+        with open(filename, 'r') as fp:
+            pack = json.load(fp)
+        if pack.get('version') != self.version:
+            sys.stdout.write('skipped (unsupported version)\n')
+        elif pack.get('platform') != self.platform:
+            sys.stdout.write('skipped (platform {})\n'.format(
+                pack.get('platform')))
+        else:
+            self.imported.update(pack.get('results', {}))
+            sys.stdout.write('ok ({} results)\n'.format(len(self.imported)))
+
+    def save(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump({
+                'version': self.version,
+                'platform': self.platform,
+                'results': self.exported,
+            }, fp, indent=2, sort_keys=True)
@@ -0,0 +1,80 @@
+import json
+import sys
+
+
+class Plan(object):
+    """What a run would do: the items of all checks, resolved against the
+    cache, with the estimated cost of the checks that still have to run.
+
+    Items without a recorded timing are estimated with the average timing of
+    the same check.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, entries):
+        self.entries.extend(entries)
+
+    def estimate(self):
+        timings = {}
+        for entry in self.entries:
+            if entry['estimate'] is not None:
+                key = (entry['stage'], entry['check'])
+                timings.setdefault(key, []).append(entry['estimate'])
+
+        for entry in self.entries:
+            key = (entry['stage'], entry['check'])
+            if entry['state'] == 'pending' and entry['estimate'] is None \
+                    and key in timings:
+                entry['estimate'] = sum(timings[key]) / len(timings[key])
+
+    def pending(self):
+        return [entry for entry in self.entries if entry['state'] == 'pending']
+
+    def summary(self):
+        pending = self.pending()
+        summary = {'checks': len(self.entries), 'pending': len(pending)}
+        for state in ('hit', 'apply', 'error'):
+            summary[state] = len([
+                entry for entry in self.entries if entry['state'] == state
+            ])
+        summary['spawns'] = len([entry for entry in pending if entry['spawns']])
+        summary['estimate'] = sum(entry['estimate'] or 0 for entry in pending)
+        summary['unknown'] = len([
+            entry for entry in pending if entry['estimate'] is None
+        ])
+        return summary
+
+    def save(self, filename):
+        self.estimate()
+        with open(filename, 'w') as fp:
+            json.dump({
+                'checks': self.entries,
+                'summary': self.summary(),
+            }, fp, indent=2, sort_keys=True)
+
+    def show(self, output=sys.stdout):
+        self.estimate()
+        for entry in self.entries:
+            line = '{:<8} {}.{} {}'.format(
+                entry['state'], entry['stage'], entry['check'], entry['name'])
+            if entry['state'] == 'hit':
+                line += ' ({})'.format('yes' if entry['result'] else 'no')
+            elif entry['state'] == 'pending':
+                if entry['spawns']:
+                    line += ' [spawns]'
+                if entry['estimate'] is not None:
+                    line += ' ~{:.3f}s'.format(entry['estimate'])
+            if entry['condition']:
+                line += ' (if {})'.format(entry['condition'])
+            output.write(line + '\n')
+
+        summary = self.summary()
+        output.write(
+            'plan: {checks} checks, {hit} cached, {apply} applied, {pending} '
+            'pending ({spawns} spawn processes), estimated {estimate:.3f}s'
+            .format(**summary))
+        if summary['unknown']:
+            output.write(' + {} unknown'.format(summary['unknown']))
+        output.write('\n')
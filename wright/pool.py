@@ -0,0 +1,220 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+_local = threading.local()
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Job(object):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.done = threading.Event()
+        self.error = None
+        self.value = None
+        self._lock = threading.Lock()
+        self._children = []
+        self._procs = []
+
+    def adopt(self, job):
+        """Add a job submitted by this job, it is cancelled along with it."""
+        with self._lock:
+            self._children.append(job)
+            cancelled = self.cancelled
+        if cancelled:
+            job.cancel()
+
+    def cancel(self):
+        """Cancel the job, kills all processes spawned by it and the jobs it
+        submitted."""
+        with self._lock:
+            self.cancelled = True
+            children = list(self._children)
+            procs = list(self._procs)
+        for job in children:
+            job.cancel()
+        for proc in procs:
+            kill(proc)
+
+    def register(self, proc):
+        with self._lock:
+            self._procs.append(proc)
+            cancelled = self.cancelled
+        if cancelled:
+            kill(proc)
+
+    def unregister(self, proc):
+        with self._lock:
+            self._procs.remove(proc)
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def run(self):
+        previous = getattr(_local, 'job', None)
+        _local.job = self
+        try:
+            if self.cancelled:
+                raise Cancelled()
+            self.value = self.func(*self.args)
+        except Exception as error:
+            self.error = error
+        finally:
+            _local.job = previous
+            self.done.set()
+
+
+class Pool(object):
+    """Pool of worker threads executing checks concurrently.
+
+    With only one job, work is executed immediately by the caller.
+    """
+
+    def __init__(self, jobs=1):
+        self.jobs = max(1, int(jobs or 1))
+        self.queue = Queue()
+        self.workers = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self.workers) < self.jobs:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            job.run()
+
+    def shutdown(self):
+        """Stop all workers, once the queued jobs have finished."""
+        with self._lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            self.queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    def submit(self, func, *args):
+        job = Job(func, args)
+        parent = getattr(_local, 'job', None)
+        if parent is not None:
+            parent.adopt(job)
+        if self.jobs == 1:
+            job.run()
+        else:
+            self._start()
+            self.queue.put(job)
+        return job
+
+
+class Usage(object):
+    """Counts the processes run by the current thread, and their time.
+
+    The CPU time is taken from the resource usage of all children of wright,
+    so it is only exact if a single check runs at a time.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'usage', None)
+        _local.usage = self
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        _local.usage = self._previous
+
+    def add(self, wall, cpu):
+        self.count += 1
+        self.wall += wall
+        self.cpu += cpu
+
+
+def children_cpu():
+    """CPU time used by the terminated child processes."""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def kill(proc):
+    """Kill a process, and on POSIX the processes it started, like the
+    compiler passes, which would otherwise keep its output open."""
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except OSError:
+        pass
+
+
+def popen(args, **kwargs):
+    """Start a process that is killed when the running job is cancelled."""
+    job = getattr(_local, 'job', None)
+    if job is not None and job.cancelled:
+        raise Cancelled()
+    if job is not None and os.name == 'posix':
+        # In its own process group, so it can be killed with its children
+        kwargs.setdefault('preexec_fn', os.setpgrp)
+    proc = subprocess.Popen(args, **kwargs)
+    if job is not None:
+        job.register(proc)
+    return proc
+
+
+def communicate(args, stdin=None, **kwargs):
+    """Run a process to completion, returns its exit code, output and error
+    output.
+
+    If stdin is given, it is written to the standard input of the process.
+    The outputs are None unless they are piped.
+    """
+    if stdin is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    start = time.time()
+    cpu = children_cpu()
+    proc = popen(args, **kwargs)
+    try:
+        out, err = proc.communicate(stdin)
+    finally:
+        job = getattr(_local, 'job', None)
+        if job is not None:
+            job.unregister(proc)
+        usage = getattr(_local, 'usage', None)
+        if usage is not None:
+            usage.add(time.time() - start, children_cpu() - cpu)
+    return proc.returncode, out, err
@@ -0,0 +1,180 @@
+import fnmatch
+import sys
+import threading
+import time
+
+from .log import LogBuffer
+from .pool import Cancelled, Job
+
+
+def overlaps(keys, others):
+    """Check if two sets of env keys overlap, None stands for any key.
+
+    Keys may contain wildcards, two keys that both contain wildcards are
+    assumed to overlap.
+    """
+    if keys is None:
+        return others is None or bool(others)
+    if others is None:
+        return bool(keys)
+    for key in keys:
+        for other in others:
+            if '*' in key and '*' in other:
+                return True
+            if fnmatch.fnmatchcase(key, other) or \
+                    fnmatch.fnmatchcase(other, key):
+                return True
+    return False
+
+
+class Section(object):
+    """A stage:check section, with the sections it depends on."""
+
+    def __init__(self, name, stage, check):
+        self.name = name
+        self.stage = stage
+        self.check = check
+        self.consumes = stage.consumes(check)
+        self.produces = stage.produces(check)
+        self.depends = []
+        self.buffer = None
+        self.done = False
+        self.error = None
+        self.job = None
+        self.result = None
+
+    def __str__(self):
+        return '{}.{}'.format(self.name, self.check)
+
+    def conflicts(self, other):
+        """Check if the order of two sections matters."""
+        return (overlaps(self.produces, other.consumes)
+            or overlaps(self.consumes, other.produces)
+            or overlaps(self.produces, other.produces))
+
+
+class Scheduler(object):
+    """Runs the sections of all stages as a dependency graph.
+
+    A section depends on the earlier sections, in configuration order, that
+    set env keys it reads, that read env keys it sets, or that set the same
+    keys. The keys are declared by the checks, and include the conditions of
+    ``_if_`` options. A section starts as soon as the sections it depends on
+    have finished, independent sections run at the same time.
+
+    The log and terminal output of every section is collected in a buffer,
+    and replayed in configuration order, so it is the same as for a
+    sequential run.
+    """
+
+    def __init__(self, log, jobs=1):
+        self.log = log
+        self.jobs = max(1, int(jobs or 1))
+        self.sections = []
+        self._condition = threading.Condition()
+        self._running = 0
+        # Set once a section failed, no more sections are started
+        self._stopped = False
+
+    def add(self, name, stage, check):
+        section = Section(name, stage, check)
+        for other in self.sections:
+            if other.conflicts(section):
+                section.depends.append(other)
+        self.sections.append(section)
+        return section
+
+    def _run(self, section):
+        buffer = section.buffer
+        buffer.write('executing stage: {}, check: {}\n'.format(
+            section.name, section.check))
+        # The processes and pool jobs of the section are killed if the job
+        # is cancelled
+        section.job.run()
+        result = section.job.value
+        if isinstance(section.job.error, Cancelled):
+            result = False
+        elif section.job.error is not None:
+            section.error = section.job.error
+            result = False
+        buffer.end = time.time()
+        with self._condition:
+            section.result = result
+            section.done = True
+            self._running -= 1
+            if not result:
+                self._stopped = True
+                self._cancel(section)
+            self._condition.notify()
+
+    def _cancel(self, failed):
+        """Cancel the running sections after a failed section.
+
+        Earlier sections run to completion, their output comes before the
+        failure, as in a sequential run.
+        """
+        for section in self.sections[self.sections.index(failed) + 1:]:
+            if section.job is not None and not section.done:
+                section.job.cancel()
+
+    def _start(self, section):
+        self._running += 1
+        section.buffer = LogBuffer(getattr(self.log, 'level', 'all'))
+        section.job = Job(section.stage.run_buffered,
+            (section.check, section.buffer))
+        thread = threading.Thread(target=self._run, args=(section,),
+            name=str(section))
+        thread.daemon = True
+        thread.start()
+
+    def _replay(self, section, previous):
+        if previous is None or previous.name != section.name:
+            self.log.write('executing stage: {}\n'.format(section.name))
+        section.buffer.replay(self.log)
+        buffer = section.buffer
+        self.log.event('stage', stage=section.name, check=section.check,
+            start=buffer.start, end=buffer.end, wall=buffer.end - buffer.start,
+            result=section.result)
+        sys.stdout.write(''.join(buffer.terminal))
+        sys.stdout.flush()
+
+    def run(self):
+        """Run all sections, returns the first one that failed, or None."""
+        for section in self.sections:
+            self.log.write('schedule: {} after {}\n'.format(section, ', '.join(
+                str(other) for other in section.depends) or 'nothing'))
+
+        pending = list(self.sections)
+        replayed = 0
+        failed = None
+        with self._condition:
+            while True:
+                for section in list(pending):
+                    if self._stopped or self._running >= self.jobs:
+                        break
+                    if all(other.done for other in section.depends):
+                        pending.remove(section)
+                        self._start(section)
+
+                # Replay the output of the finished sections, in order
+                while replayed < len(self.sections) and failed is None:
+                    section = self.sections[replayed]
+                    if not section.done:
+                        if self._running or section not in pending:
+                            break
+                        # Not started because another section failed
+                        replayed += 1
+                        continue
+                    self._replay(section, self.sections[replayed - 1]
+                        if replayed else None)
+                    replayed += 1
+                    if section.error is not None:
+                        raise section.error
+                    if not section.result:
+                        failed = section
+
+                if not self._running and (self._stopped or not pending):
+                    break
+                self._condition.wait()
+
+        return failed
@@ -0,0 +1,171 @@
+import fnmatch
+import hashlib
+import json
+import os
+import sys
+
+from .util import digest, file_identity, plain
+
+# Environment variables that change without affecting the configuration,
+# like the jobserver and recursion level of make, which differ for every build
+VOLATILE_ENVIRON = ('_', 'MAKEFLAGS', 'MAKELEVEL', 'MAKE_TERMERR',
+    'MAKE_TERMOUT', 'MFLAGS', 'OLDPWD', 'SHLVL')
+# Larger inputs, like compilers, are compared by identity instead of content
+MAX_CONTENT_SIZE = 1 << 20
+
+
+def file_digest(filename):
+    """Digest of a file's contents, the identity of directories and large
+    files, or None if it doesn't exist."""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if not os.path.isfile(filename) or stat.st_size > MAX_CONTENT_SIZE:
+        return file_identity(filename)
+    with open(filename, 'rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+def environ_digest(keys=None):
+    """Digest of the process environment, or only of the variables that match
+    the keys, which may contain wildcards. Volatile variables are left out."""
+    items = []
+    for key, value in os.environ.items():
+        if key in VOLATILE_ENVIRON:
+            continue
+        if keys is not None and not any(
+                fnmatch.fnmatchcase(key, pattern) for pattern in keys):
+            continue
+        items.append([key, value])
+    return digest(sorted(items))
+
+
+def git_head(directory='.git'):
+    """Return the commit of HEAD, read from the repository without git."""
+    try:
+        with open(os.path.join(directory, 'HEAD')) as fp:
+            head = fp.read().strip()
+    except (IOError, OSError):
+        return None
+    if not head.startswith('ref: '):
+        return head
+
+    ref = head[5:]
+    try:
+        with open(os.path.join(directory, ref)) as fp:
+            return fp.read().strip()
+    except (IOError, OSError):
+        pass
+    try:
+        with open(os.path.join(directory, 'packed-refs')) as fp:
+            for line in fp:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    except (IOError, OSError):
+        pass
+    return ref
+
+
+class Snapshot(object):
+    """Snapshot of the environment of the last successful run.
+
+    The snapshot includes a manifest of everything that went into the run:
+    the command line, the variables of the process environment the run read,
+    the configuration, the inputs of the checks, like compilers and sources,
+    and the git HEAD. If none of them changed, and the generated files and
+    the cache are untouched, the run can be skipped.
+    """
+
+    version = 2
+
+    def __init__(self, filename, cache=None):
+        self.filename = filename
+        self.cache = cache
+        self.data = None
+
+    def base(self, argv):
+        """The part of the manifest that can be checked before parsing."""
+        package = os.path.dirname(os.path.abspath(__file__))
+        code = []
+        for directory in (package, os.path.join(package, 'stage')):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith('.py'):
+                    code.append(file_identity(os.path.join(directory, name)))
+
+        return {
+            'argv': list(argv),
+            'cwd': os.getcwd(),
+            'git': git_head(),
+            'python': [sys.executable, sys.hexversion],
+            'wright': digest(code),
+        }
+
+    def load(self):
+        try:
+            with open(self.filename) as fp:
+                data = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+        if data.get('version') != self.version:
+            return None
+        return data
+
+    def matches(self, argv):
+        """Check if nothing changed since the snapshot was taken."""
+        # The cache is written at exit, after the snapshot, so only its
+        # presence can be checked
+        if self.cache is not None and not os.path.exists(self.cache):
+            return False
+        self.data = self.load()
+        if self.data is None:
+            return False
+        manifest = self.data['manifest']
+        if manifest['base'] != self.base(argv):
+            return False
+        environ = manifest['environ']
+        if environ_digest(environ['keys']) != environ['digest']:
+            return False
+        for filename, value in manifest['inputs'].items():
+            if file_digest(filename) != value:
+                return False
+        for filename, identity in manifest['outputs'].items():
+            if file_identity(filename) != identity:
+                return False
+        return True
+
+    def env(self):
+        return self.data['env']
+
+    def remove(self):
+        if os.path.isfile(self.filename):
+            os.unlink(self.filename)
+
+    def save(self, argv, env, inputs, outputs, environ=None):
+        """Store the environment, with the files it was produced from.
+
+        Only the variables of the process environment that match environ are
+        recorded, all of them if it is None.
+        """
+        if environ is not None:
+            environ = sorted(environ)
+        data = {
+            'version': self.version,
+            'manifest': {
+                'base': self.base(argv),
+                'environ': {
+                    'keys': environ,
+                    'digest': environ_digest(environ),
+                },
+                'inputs': dict(
+                    (filename, file_digest(filename)) for filename in inputs
+                ),
+                'outputs': dict(
+                    (filename, file_identity(filename)) for filename in outputs
+                ),
+            },
+            'env': plain(dict(env)),
+        }
+        with open(self.filename, 'w') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
@@ -1,10 +1,18 @@
+import atexit
+import errno
 import os
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 
-from ..util import normal_case
+from ..log import LogBuffer
+from ..pool import Pool, Usage, communicate
+from ..trace import Span
+from ..util import digest, normal_case
 
 RE_ENV_UNSAFE = re.compile(r'[^\w_]')
 
@@ -17,14 +25,25 @@ except NameError:
 
 
 class Check(object):
+    # Checks that can probe many items at once implement batch(), it is used
+    # with --batch, or always if always_batch is set
+    always_batch = False
+    batched = False
     cache = True
     order = 100
+    # Checks that only read from the environment may run concurrently
+    parallel = False
+    # Checks that only update the environment, they are applied by --plan
+    pure = False
     quiet = False
 
     def __init__(self, stage):
         self.stage = stage
         self.env = self.stage.env
-        self.output = self.stage.output
+
+    @property
+    def output(self):
+        return self.stage.output
 
     def env_key(self, item):
         return RE_ENV_UNSAFE.sub('_', item).strip('_').upper()
@@ -40,44 +59,88 @@ class Check(object):
             return normal_case(self.__class__.__name__[5:])
         return normal_case(self.__class__.__name__)
 
+    def batch(self, items):
+        return [self(name, args) for name, args in items]
+
+    def describe(self, result):
+        """Text shown for a successful result."""
+        return 'yes'
+
+    def fingerprint(self, name, args):
+        """Data, besides name and args, that affects the result of a check.
+
+        The digest of the fingerprint is part of the cache key.
+        """
+        return None
+
+    def consumes(self, name, args):
+        """Env keys read by the check of an item, None if it may read any key.
+        """
+        return None
+
+    def produces(self, name, args):
+        """Env keys set by the check of an item, None if it may set any key.
+
+        Together with consumes, they decide which sections the scheduler can
+        run at the same time. Keys may contain wildcards.
+        """
+        return None
+
+    def inputs(self, name, args):
+        """Files and directories the result of a check depends on.
+
+        They are part of the manifest of the run snapshot.
+        """
+        return []
+
+    def restore(self, name, result):
+        """Apply the side effects of a successful, cached, result."""
+        pass
+
     def __call__(self, *args):
         return False
 
 
 class CheckExec(Check):
-    def __call__(self, args):
+    def __call__(self, args, stdin=None):
         self.output.write('exec: {}\n'.format(' '.join(args)))
-        self.output.flush()
-        try:
-            code = subprocess.call(
-                args,
-                stdout=self.output,
-                stderr=self.output)
-        except WindowsError:
-            code = errno.errorcode
+        with Span('exec', os.path.basename(args[0]), args=args) as attrs:
+            try:
+                code, text, _ = communicate(
+                    args,
+                    stdin=stdin,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    universal_newlines=True)
+                if text:
+                    self.output.write(text, detail=True)
+            except (OSError, WindowsError) as error:
+                code = errno.errorcode.get(error.errno, error.errno)
+            attrs['code'] = code
 
         self.output.write('return code: {}\n'.format(code))
-        self.output.flush()
         return code == 0
 
 
 class CheckExecOutput(Check):
     def __call__(self, args):
         self.output.write('exec: {}\n'.format(' '.join(args)))
-        self.output.flush()
         try:
-            pipe = subprocess.Popen(
+            code, text, errors = communicate(
                 args,
                 stdout=subprocess.PIPE,
-                stderr=self.output)
-            text = pipe.communicate()[0]
-            self.output.write('result:\n{}\n'.format(text.strip()))
-            self.output.flush()
-            if pipe.returncode == 0:
-                return text
-        except WindowsError:
+                stderr=subprocess.PIPE,
+                universal_newlines=True)
+        except (OSError, WindowsError) as error:
+            self.output.write('error: {}\n'.format(error))
             return None
 
+        if errors:
+            self.output.write(errors, detail=True)
+        self.output.write('result:\n{}\n'.format(text.strip()), detail=True)
+        if code == 0:
+            return text
+
 
 class Stage(object):
     color = {
@@ -88,14 +151,36 @@ class Stage(object):
         'blue':   '\x1b[1;34m',
     }
 
-    def __init__(self, config, cache, env={}, output=sys.stderr):
+    def __init__(self, config, cache, env={}, output=sys.stderr, pool=None,
+                 scratch=None):
         self.config = config
         self.cache = cache
         self.env = env
-        self.x_pos = 0
         self.output = output
-        # Registry of check commands
+        self.pool = pool or Pool()
+        self.scratch = scratch or Scratch()
+        # Registry of check commands, and their names sorted by order
         self._check = {}
+        self._order = None
+
+    @property
+    def output(self):
+        # Concurrent checks write to a buffer local to their worker thread
+        return getattr(self._local, 'output', None) or self._output
+
+    @output.setter
+    def output(self, output):
+        self._local = threading.local()
+        self._output = output
+
+    @property
+    def x_pos(self):
+        # Sections run by the scheduler each have their own terminal line
+        return getattr(self._local, 'x_pos', 0)
+
+    @x_pos.setter
+    def x_pos(self, x_pos):
+        self._local.x_pos = x_pos
 
     def __getitem__(self, check):
         return self._check[check]
@@ -105,9 +190,10 @@ class Stage(object):
         return normal_case(self.__class__.__name__)
 
     def checks(self):
-        checks = self._check.items()
-        checks.sort(key=lambda item: item[1].order)
-        for name, _ in checks:
+        if self._order is None:
+            self._order = [name for name, _ in sorted(
+                self._check.items(), key=lambda item: item[1].order)]
+        for name in self._order:
             if self.config.has_check(self.name, name):
                 yield name
 
@@ -117,13 +203,18 @@ class Stage(object):
     def echo(self, what, color='normal', append=''):
         what = str(what)
         self.x_pos += len(what)
-        sys.stdout.write(''.join([
+        text = ''.join([
             self.color[color],
             what,
             self.color['normal'],
             append,
-        ]))
-        sys.stdout.flush()
+        ])
+        terminal = getattr(self._local, 'terminal', None)
+        if terminal is not None:
+            terminal.append(text)
+        else:
+            sys.stdout.write(text)
+            sys.stdout.flush()
 
     def echo_result(self, result, color='normal', append='\n'):
         pad = ' ' * max(0, 64 - self.x_pos)
@@ -131,22 +222,340 @@ class Stage(object):
         self.x_pos = 0
 
     def run(self, check):
-        self.output.write('stage {}.{}:\n'.format(self.name, check))
-        for name, args in self.config.required(self.name, check):
-            if not self._run_check(check, name, args):
+        with Span('stage', '{}.{}'.format(self.name, check)) as attrs:
+            self.output.write('stage {}.{}:\n'.format(self.name, check))
+            items = self.config.section_items
+            attrs['result'] = self._run_checks(
+                check, items(self.name, check, True))
+            if attrs['result']:
+                self._run_checks(check, items(self.name, check, False), True)
+        return attrs['result']
+
+    def enabled(self, item):
+        """Check the condition of an item against the current env."""
+        return item.condition is None or bool(self.env.get(item.condition))
+
+    def run_buffered(self, check, buffer):
+        """Run a check with the log and terminal output of the current thread
+        collected in a buffer."""
+        self._local.output = buffer
+        self._local.terminal = buffer.terminal
+        try:
+            return self.run(check)
+        finally:
+            self._local.output = None
+            self._local.terminal = None
+
+    def _run_checks(self, check, items, optional=False):
+        test = self._check.get(check)
+        batch = test is not None and test.batched and (
+            test.always_batch or self.env.get('BATCH'))
+        if test is None or not (batch or test.parallel and self.pool.jobs > 1):
+            for item in items:
+                if not self.enabled(item):
+                    continue
+                if not self._run_check(check, item.name, item.args, optional):
+                    if not optional:
+                        return False
+            return True
+
+        from ..schedule import overlaps
+
+        # The items run in rounds, conditions are evaluated when a round is
+        # started. A round ends before the first item with a condition that
+        # may be set by an earlier item of the round.
+        items = list(items)
+        while items:
+            group = []
+            produced = set()
+            while items:
+                item = items[0]
+                if item.condition is not None and \
+                        overlaps(produced, [item.condition]):
+                    break
+                items.pop(0)
+                if not self.enabled(item):
+                    continue
+                group.append((item.name, item.args))
+                keys = test.produces(item.name, item.args)
+                if keys is None or produced is None:
+                    produced = None
+                else:
+                    produced.update(keys)
+
+            if not self._run_group(test, check, group, batch, optional):
                 return False
+        return True
 
-        for name, args in self.config.optional(self.name, check):
-            self._run_check(check, name, args, True)
+    def _run_group(self, test, check, items, batch, optional):
+        # Submit all probes that are not cached, the results are collected in
+        # configuration order, so the log and terminal output are the same as
+        # for sequential runs.
+        keys = []
+        cached = []
+        probes = []
+        for index, (name, args) in enumerate(items):
+            cache_key = self._cache_key(test, check, name, args)
+            keys.append(cache_key)
+            cached.append(self._cached(test, cache_key, optional))
+            if cached[index] is None:
+                probes.append(index)
+
+        if batch:
+            # One batch per worker
+            size = max(1, -(-len(probes) // self.pool.jobs))
+            groups = [probes[i:i + size] for i in range(0, len(probes), size)]
+        else:
+            groups = [[index] for index in probes]
+
+        pending = [None] * len(items)
+        for group in groups:
+            job = self.pool.submit(self._probe, test, check,
+                [items[index] for index in group], batch)
+            for offset, index in enumerate(group):
+                pending[index] = (job, offset)
+
+        for index, (name, args) in enumerate(items):
+            if pending[index] is None:
+                self.output.write('stage {}.{}: run name={!r}, args={!r}\n'.format(
+                    self.name, check, name, args))
+                if not test.quiet:
+                    self.checking(' '.join([check, name]))
+                self._report(test, name, keys[index], cached[index], optional,
+                    True)
+                self._record(check, name, args, cached[index])
+                continue
+
+            job, offset = pending[index]
+            results, buffer = job.result()
+            if offset == 0:
+                buffer.replay(self.output, failed=not all(results))
+            if not test.quiet:
+                self.checking(' '.join([check, name]))
+            result = self._report(test, name, keys[index], results[offset],
+                optional)
+            self._record(check, name, args, results[offset], buffer,
+                len(results))
+            if not result and not optional:
+                for other in pending[index + 1:]:
+                    if other is not None:
+                        other[0].cancel()
+                return False
 
         return True
 
+    def _probe(self, test, check, items, batch=False):
+        """Run a check in a worker, collecting its log output in a buffer."""
+        previous = getattr(self._local, 'output', None)
+        self._local.output = buffer = LogBuffer()
+        try:
+            with Span('probe', check, stage=self.name,
+                      names=[name for name, _ in items]), \
+                    Usage() as buffer.usage:
+                if batch:
+                    buffer.write('stage {}.{}: batch names={!r}\n'.format(
+                        self.name, check, [name for name, _ in items]))
+                    return test.batch(items), buffer
+
+                name, args = items[0]
+                buffer.write('stage {}.{}: run name={!r}, args={!r}\n'.format(
+                    self.name, check, name, args))
+                return [test(name, args)], buffer
+        finally:
+            buffer.end = time.time()
+            self._local.output = previous
+
+    def _record(self, check, name, args, result, buffer=None, share=1):
+        """Log the timing of a check, probes in a batch share its time."""
+        fields = {
+            'stage': self.name,
+            'check': check,
+            'name': name,
+            'args': args,
+            'result': bool(result),
+            'cache': 'miss' if buffer else 'hit',
+        }
+        if buffer is not None:
+            self.cache[self._timing_key(check, name)] = round(
+                (buffer.end - buffer.start) / share, 6)
+            fields.update({
+                'start': buffer.start,
+                'end': buffer.end,
+                'wall': (buffer.end - buffer.start) / share,
+                'procs': buffer.usage.count,
+                'proc_wall': buffer.usage.wall / share,
+                'proc_cpu': buffer.usage.cpu / share,
+            })
+            if share > 1:
+                fields['batch'] = share
+        self.output.event('check', **fields)
+
+    def _timing_key(self, check, name):
+        # Not part of the stage:check prefix, so it survives invalidation
+        return ('.timing', self.name, check, name)
+
+    def _cache_key(self, test, check, name, args):
+        cache_key = (self.name, check, name, args)
+        if test.cache:
+            fingerprint = test.fingerprint(name, args)
+            if fingerprint is not None:
+                cache_key += (digest(fingerprint),)
+        return cache_key
+
+    def _cached(self, test, cache_key, optional=False):
+        """Return the cached result of a check, or None if it has to run.
+
+        Failed results are only used for optional checks, unless the
+        RECHECK_FAILED option is set.
+        """
+        if not test.cache or cache_key not in self.cache:
+            return None
+        result = self.cache[cache_key]
+        if result:
+            return result
+        if optional and not self.env.get('RECHECK_FAILED'):
+            return False
+        return None
+
+    def _report(self, test, name, cache_key, result, optional=False,
+                cached=False):
+        test.have(name, result)
+        append = ' (cached)\n' if cached else '\n'
+        if result:
+            if cached:
+                test.restore(name, result)
+            elif test.cache:
+                self.cache[cache_key] = result
+            if not test.quiet:
+                self.echo_result(test.describe(result), color='green',
+                    append=append)
+            return True
+        else:
+            if test.cache and optional and not cached:
+                self.cache[cache_key] = False
+            if not test.quiet:
+                self.echo_result('no', color='yellow' if optional else 'red',
+                    append=append)
+            return False
+
+    def inputs(self, check):
+        """Files and directories the checks of a section depend on."""
+        test = self._check.get(check)
+        inputs = []
+        if test is None:
+            return inputs
+        items = list(self.config.required(self.name, check))
+        items.extend(self.config.optional(self.name, check))
+        for name, args in items:
+            for filename in test.inputs(name, args):
+                if filename and filename not in inputs:
+                    inputs.append(filename)
+        return inputs
+
+    def outputs(self, check):
+        """Files generated by the checks of a section."""
+        return []
+
+    def environ(self, check):
+        """Env keys the checks of a section read in this run, None if any key.
+
+        Only these variables of the process environment are part of the run
+        snapshot.
+        """
+        return self.consumes(check)
+
+    def consumes(self, check):
+        """Env keys read by the checks of a section, None if any key."""
+        test = self._check.get(check)
+        if test is None:
+            return None
+        keys = set()
+        for item in self.config.check_items(self.name, check):
+            consumed = test.consumes(item.name, item.args)
+            if consumed is None:
+                return None
+            keys.update(consumed)
+            if item.condition is not None:
+                keys.add(item.condition)
+        return keys
+
+    def produces(self, check):
+        """Env keys set by the checks of a section, None if any key."""
+        test = self._check.get(check)
+        keys = set()
+        if test is None:
+            return keys
+        for item in self.config.check_items(self.name, check):
+            produced = test.produces(item.name, item.args)
+            if produced is None:
+                return None
+            keys.update(produced)
+        return keys
+
+    def plan(self, check, changed=()):
+        """Resolve the items of a check against the cache, without probing.
+
+        Yields a dict for every item. Cached results and pure checks are
+        applied to the environment, so later checks resolve as in a real run.
+        Items that depend on an environment key that is not known yet are
+        included, with the key as condition.
+        """
+        test = self._check.get(check)
+        stale = ':'.join([self.name, check]) in changed
+        for item in self.config.check_items(self.name, check):
+            condition = item.condition
+            if condition in self.env and not self.env[condition]:
+                continue
+            name, args, optional = item.name, item.args, not item.required
+            entry = {
+                'stage': self.name,
+                'check': check,
+                'name': name,
+                'args': list(args),
+                'optional': optional,
+                'condition': None,
+                'spawns': isinstance(test, CheckExec),
+                'estimate': None,
+            }
+            if condition is not None and condition not in self.env:
+                entry['condition'] = condition
+            if test is None:
+                entry['state'] = 'error'
+            elif test.pure:
+                entry['state'] = 'apply'
+                test(name, args)
+            else:
+                entry.update(self._plan_item(test, check, name, args,
+                    optional, stale))
+            yield entry
+
+    def _plan_item(self, test, check, name, args, optional, stale):
+        cached = None
+        if not stale:
+            cached = self._cached(test,
+                self._cache_key(test, check, name, args), optional)
+        if cached is None:
+            return {
+                'state': 'pending',
+                'estimate': self.cache.get(self._timing_key(check, name)),
+            }
+
+        test.have(name, cached)
+        if cached:
+            test.restore(name, cached)
+        return {'state': 'hit', 'result': bool(cached), 'spawns': False}
+
     def _run_check(self, check, name, args, optional=False):
-        self.output.write('stage {}.{}: run name={!r}, args={!r}\n'.format(
-            self.name, check, name, args))
+        with Span('check', ' '.join([check, name]), stage=self.name) as attrs:
+            attrs['result'] = self._check_one(check, name, args, optional)
+        return attrs['result']
+
+    def _check_one(self, check, name, args, optional=False):
         try:
             test = self[check]
         except KeyError:
+            self.output.write('stage {}.{}: run name={!r}, args={!r}\n'.format(
+                self.name, check, name, args))
             self.echo_result('fail', color='red')
             self.echo('stage "{}" has no check "{}"\n'.format(self.name, check))
             return False
@@ -154,48 +563,66 @@ class Stage(object):
         if not test.quiet:
             self.checking(' '.join([check, name]))
 
-        cache_key = (self.name, check, name, args)
-        if test.cache and cache_key in self.cache:
-            if self.cache[cache_key]:
-                test.have(name, True)
-                if not test.quiet:
-                    self.echo_result('yes', color='green', append=' (cached)\n')
-                return True
-
-        result = test(name, args)
-        test.have(name, result)
-        if result:
-            if test.cache:
-                self.cache[cache_key] = result
-            if not test.quiet:
-                self.echo_result('yes', color='green')
-            return True
+        cache_key = self._cache_key(test, check, name, args)
+        cached = self._cached(test, cache_key, optional)
+        if cached is not None:
+            self.output.write('stage {}.{}: run name={!r}, args={!r}\n'.format(
+                self.name, check, name, args))
+            result = self._report(test, name, cache_key, cached, optional,
+                True)
+            self._record(check, name, args, cached)
+            return result
+
+        results, buffer = self._probe(test, check, [(name, args)])
+        buffer.replay(self.output, failed=not results[0])
+        result = self._report(test, name, cache_key, results[0], optional)
+        self._record(check, name, args, results[0], buffer)
+        return result
+
+
+class Scratch(object):
+    """Scratch directory for the artifacts of checks, shared by a run.
+
+    The directory is created on tmpfs if available, and removed at exit. If
+    keep is set, the artifacts of failed checks are kept.
+    """
+
+    def __init__(self, keep=False):
+        self.keep = keep
+        self.path = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def cleanup(self):
+        if self.path is None:
+            return
+        if not self.keep:
+            shutil.rmtree(self.path, True)
+        elif not os.listdir(self.path):
+            os.rmdir(self.path)
         else:
-            if not test.quiet:
-                self.echo_result('no', color='yellow' if optional else 'red')
-            return False
+            sys.stdout.write('kept failed probes in {}\n'.format(self.path))
+
+    def filename(self, prefix='', suffix=''):
+        """Return a new unique filename in the scratch directory."""
+        with self._lock:
+            if self.path is None:
+                tmpfs = '/dev/shm'
+                if not (os.path.isdir(tmpfs) and os.access(tmpfs, os.W_OK)):
+                    tmpfs = None
+                self.path = tempfile.mkdtemp(prefix='wright-', dir=tmpfs)
+                atexit.register(self.cleanup)
+            self._count += 1
+            return os.path.join(self.path, '{}{}{}'.format(
+                prefix, self._count, suffix))
+
+    def remove(self, filename):
+        try:
+            os.unlink(filename)
+        except (IOError, OSError):
+            pass
 
+    def save(self, filename, content):
+        with open(filename, 'w') as fp:
+            fp.write(content)
 
-class TempFile:
-    def __init__(self, prefix='', suffix='tmp', content=None):
-        self.prefix = prefix
-        self.suffix = suffix
-        self.content = content
-        self.filename = None
-
-    def __enter__(self):
-        fd, self.filename = tempfile.mkstemp(
-            suffix=self.suffix,
-            prefix=self.prefix)
-        if self.content is not None:
-            os.write(fd, self.content)
-        os.close(fd)
-        return self
-
-    def __exit__(self, typ, value, traceback):
-        if self.filename is not None:
-            try:
-                os.unlink(self.filename)
-            except (IOError, OSError):
-                pass
-            self.filename = None
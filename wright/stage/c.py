@@ -1,14 +1,146 @@
+import collections
+import os
+import re
 import shlex
+import string
+import subprocess
+import tempfile
+import threading
+
+from .base import Check, CheckExec, Stage
+from ..pool import communicate
+from ..trace import Span
+from ..util import (FLAG_KEYS, STR_TYPES, file_identity, memoize,
+    parse_flags, read_file, which)
+
+RE_DEFINE = re.compile(r'^#define\s+(\w+)(?:\([^)]*\))?\s*(.*)$')
+# Marked values in object files, see CheckValue
+RE_VALUE = re.compile(br'@wright:(\d{4}):(\d{10})')
+
+
+
+@memoize
+def syntax_only(compiler):
+    """Check if the compiler supports -fsyntax-only, once per run."""
+    try:
+        pipe = subprocess.Popen(
+            [compiler, '-fsyntax-only', '-x', 'c', os.devnull],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        pipe.communicate()
+    except OSError:
+        return False
+    return pipe.returncode == 0
+
+
+@memoize
+def pch_support(compiler):
+    """Check if the compiler can build precompiled headers, once per run."""
+    fd, header = tempfile.mkstemp(prefix='wright-', suffix='.h')
+    os.close(fd)
+    try:
+        pipe = subprocess.Popen(
+            [compiler, '-x', 'c-header', header, '-o', header + '.gch'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        pipe.communicate()
+    except OSError:
+        return False
+    finally:
+        for filename in (header, header + '.gch'):
+            if os.path.exists(filename):
+                os.unlink(filename)
+    return pipe.returncode == 0
+
+
+@memoize
+def toolchain(compiler, path=None):
+    """Return the identity of a compiler, it is resolved once per run.
+
+    The identity consists of the resolved path, modification time, size and
+    version output of the compiler.
+    """
+    full = which(compiler, path)
+    if full is None:
+        return [compiler, None, None, None]
+
+    identity = file_identity(full)
+    try:
+        pipe = subprocess.Popen(
+            [identity[0], '--version'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        version = pipe.communicate()[0].strip()
+    except OSError:
+        version = None
+    return identity + [version]
+
+
+class PrecompiledHeaders(object):
+    """Precompiled headers, for sets of headers included by many probes.
+
+    Building a precompiled header costs about as much as several probes, and
+    a few headers parse about as fast as their precompiled version. A header
+    is only precompiled for sets of enough headers, once the set was used
+    often enough with the same compiler and flags, and included with
+    ``-include``. Compilers fall back to the header itself if they can't use
+    the precompiled header.
+    """
 
-from .base import Check, CheckExec, Stage, TempFile
-from ..util import parse_flags
+    min_headers = 3
+    min_uses = 4
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._headers = {}
+
+    def get(self, check, headers, args=()):
+        """Return the header to include instead of the headers, or None."""
+        compiler = check.compiler()
+        # Kept probes should compile without the scratch directory
+        if len(headers) < self.min_headers or check.stage.scratch.keep \
+                or not pch_support(compiler):
+            return None
+
+        # Link flags don't affect the precompiled header
+        args = tuple(
+            arg for arg in check.flags(args)
+            if not arg.startswith('-l') and not arg.startswith('-L'))
+        key = (compiler, tuple(headers), args)
+        with self._lock:
+            entry = self._headers.setdefault(key, [threading.Lock(), 0, None])
+            entry[1] += 1
+            if entry[1] < self.min_uses:
+                return None
+
+        # Probes for the same headers wait for the first build to complete
+        with entry[0]:
+            if entry[2] is None:
+                entry[2] = check.precompile(headers, args) or False
+        return entry[2] or None
 
 
 class CheckEnv(Check):
     cache = False
     order = 50
+    pure = True
     quiet = True
 
+    def consumes(self, name, args):
+        # The keys of the format fields in the flags
+        keys = []
+        for arg in (name,) + tuple(args):
+            if arg and isinstance(arg, STR_TYPES):
+                keys.extend(
+                    re.split(r'[.\[]', field)[0]
+                    for _, field, _, _ in string.Formatter().parse(arg)
+                    if field)
+        return keys
+
+    def produces(self, name, args):
+        return ['HAVE_' + self.env_key(name)] + list(FLAG_KEYS)
+
     def __call__(self, *args):
         for arg in args:
             if not arg:
@@ -19,96 +151,388 @@ class CheckEnv(Check):
 
 
 class CheckCompile(CheckExec):
-    def __call__(self, source, args=(), run=False):
-        cross_compile = self.env.get('CROSS_COMPILE', '')
-        cross_execute = shlex.split(self.env.get('CROSS_EXECUTE', ''))
-        cc = self.env.get('CC', 'gcc')
-        compiler = cross_compile + cc
+    parallel = True
+
+    def compiler(self):
+        return self.env.get('CROSS_COMPILE', '') + self.env.get('CC', 'gcc')
+
+    def fingerprint(self, source, args=()):
+        return [
+            toolchain(self.compiler(), self.env.get('PATH')),
+            self.flags(args),
+            read_file(source),
+        ]
 
+    def inputs(self, source, args=()):
+        return [which(self.compiler(), self.env.get('PATH')), source]
+
+    def consumes(self, name, args):
+        return ('BINEXT', 'CC', 'CROSS_COMPILE', 'CROSS_EXECUTE',
+            'PATH') + FLAG_KEYS
+
+    def produces(self, name, args):
+        return ['HAVE_' + self.env_key(name)]
+
+    def flags(self, args=()):
+        """Extend the compiler arguments with library and include paths."""
+        args = tuple(args)
         for path in self.env.get('LIBPATH', []):
             args += ('-L' + path,)
 
         for inc in self.env.get('INCLUDES', []):
             args += ('-I' + inc,)
 
-        with open(source, 'r') as fp:
-            self.output.write('script: %s\n%s\n' % (source, fp.read()))
+        return args
 
-        with TempFile('compile') as temp:
-            if super(CheckCompile, self).__call__((
-                    compiler, source, '-o', temp.filename,
-                ) + args):
-                if not run:
-                    return True
+    def build(self, inputs, args=(), run=False, link=True, source=None,
+              prefix='compile'):
+        """Compile (and optionally link and run) the inputs.
 
-                run_args = (temp.filename,)
+        If source is given, it is piped to the compiler.
+        """
+        cross_execute = shlex.split(self.env.get('CROSS_EXECUTE', ''))
+        compiler = self.compiler()
+        args = self.flags(args)
+
+        scratch = self.stage.scratch
+        output = scratch.filename(prefix, self.env.get('BINEXT', ''))
+        if not (link or run):
+            # Only check if the source compiles, skip code generation if the
+            # compiler supports it
+            if syntax_only(compiler):
+                flags = ('-fsyntax-only',)
+            else:
+                flags = ('-c', '-o', os.devnull)
+            result = super(CheckCompile, self).__call__((
+                compiler,
+            ) + flags + inputs + args, stdin=source)
+
+        else:
+            result = super(CheckCompile, self).__call__((
+                compiler,
+            ) + inputs + ('-o', output) + args, stdin=source)
+            if result and run:
+                run_args = (output,)
                 if cross_execute:
                     run_args = tuple(cross_execute) + run_args
-                return super(CheckCompile, self).__call__(run_args)
+                result = super(CheckCompile, self).__call__(run_args)
+
+        if result or not scratch.keep:
+            scratch.remove(output)
+        else:
+            if source is not None:
+                scratch.save(output + '.c', source)
+            self.output.write('kept: {}\n'.format(output))
+        return result
+
+    def precompile(self, headers, args=()):
+        """Build a precompiled header, returns the header or None."""
+        scratch = self.stage.scratch
+        header = scratch.filename('pch', '.h')
+        scratch.save(header, ''.join(
+            '#include <%s>\n' % (name,) for name in headers))
+        if super(CheckCompile, self).__call__((
+                self.compiler(), '-x', 'c-header', header,
+                '-o', header + '.gch') + tuple(args)):
+            return header
+        scratch.remove(header + '.gch')
+        return None
+
+    def object(self, source, args=(), prefix='object'):
+        """Compile source code to an object file, returns its contents.
+
+        Returns None if the source doesn't compile.
+        """
+        self.output.write('script: <stdin>\n%s\n' % (source,), detail=True)
+        scratch = self.stage.scratch
+        output = scratch.filename(prefix, '.o')
+        result = super(CheckCompile, self).__call__((
+            self.compiler(), '-c', '-x', 'c', '-', '-o', output,
+        ) + self.flags(args), stdin=source)
+
+        data = None
+        if result:
+            with open(output, 'rb') as fp:
+                data = fp.read()
+        if result or not scratch.keep:
+            scratch.remove(output)
+        else:
+            scratch.save(output + '.c', source)
+            self.output.write('kept: {}\n'.format(output))
+        return data
+
+    def compile(self, source, args=(), run=False, link=True, prefix='compile'):
+        """Compile source code, without writing it to a file."""
+        self.output.write('script: <stdin>\n%s\n' % (source,), detail=True)
+        return self.build(('-x', 'c', '-'), args, run, link, source, prefix)
+
+    def __call__(self, source, args=(), run=False, link=True):
+        self.output.write('script: %s\n%s\n' % (source, read_file(source)),
+            detail=True)
+        return self.build((source,), args, run, link)
 
 
 class CheckDefine(CheckCompile):
+    """Check if a macro is defined, after including the headers.
+
+    The defined macros are read from a single preprocessor dump for each set
+    of headers, so no programs have to be linked or executed.
+
+    Example::
+
+        [c:define]
+        optional = SO_REUSEPORT: sys/socket.h
+    """
+
     order = 100
-    source = '''
-int main() {
-#if defined(%s)
-    return 0;
-#else
-    return 42;
-#endif
-}
-'''
 
-    def __call__(self, name, headers=()):
-        source = self.source % (name,)
+    def __init__(self, stage):
+        super(CheckDefine, self).__init__(stage)
+        self._lock = threading.Lock()
+        self._macros = {}
+
+    def macros(self, headers=()):
+        """Return the macros (name: value) defined by the headers."""
+        headers = tuple(headers)
+        with self._lock:
+            entry = self._macros.setdefault(headers, [threading.Lock(), None])
+
+        # Checks for the same headers wait for the first dump to complete
+        with entry[0]:
+            if entry[1] is None:
+                entry[1] = self._dump(headers)
+        return entry[1]
+
+    def _dump(self, headers):
+        source = ''
         for header in headers:
-            source = '#include <{}>\n'.format(header) + source
-        with TempFile('define', '.c', content=source) as temp:
-            return super(CheckDefine, self).__call__(temp.filename, run=True)
+            source += '#include <%s>\n' % (header,)
+        self.output.write('script: macros\n%s\n' % (source,), detail=True)
+
+        args = (self.compiler(),)
+        for inc in self.env.get('INCLUDES', []):
+            args += ('-I' + inc,)
+
+        args += ('-dM', '-E', '-x', 'c', '-')
+        self.output.write('exec: {}\n'.format(' '.join(args)))
+        with Span('exec', os.path.basename(args[0]), args=args) as attrs:
+            try:
+                code, text, _ = communicate(
+                    args,
+                    stdin=source,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    universal_newlines=True)
+            except OSError:
+                code, text = None, ''
+            attrs['code'] = code
+
+        self.output.write('return code: {}\n'.format(code))
+        macros = {}
+        if code != 0:
+            self.output.write(text, detail=True)
+        else:
+            for line in text.splitlines():
+                match = RE_DEFINE.match(line)
+                if match:
+                    macros[match.group(1)] = match.group(2)
+            self.output.write('macros: {}\n'.format(len(macros)))
+        return macros
+
+    def fingerprint(self, name, headers=()):
+        return [
+            toolchain(self.compiler(), self.env.get('PATH')),
+            list(self.env.get('INCLUDES', [])),
+            headers,
+        ]
+
+    def inputs(self, name, headers=()):
+        return [which(self.compiler(), self.env.get('PATH'))]
+
+    def __call__(self, name, headers=()):
+        return name in self.macros(headers)
 
 
 class CheckFeature(CheckCompile):
+    def fingerprint(self, feature, args):
+        return super(CheckFeature, self).fingerprint(args[0], args[1:]) + [
+            self.env.get('CROSS_EXECUTE', ''),
+        ]
+
+    def inputs(self, feature, args):
+        return super(CheckFeature, self).inputs(args[0], args[1:])
+
     def __call__(self, feature, args):
         source = args[0]
         args = args[1:]
         return super(CheckFeature, self).__call__(source, args, run=True)
 
 
-class CheckHeader(CheckCompile):
-    order = 200
+class CheckProgram(CheckCompile):
+    """Base for checks that generate a test program for each item.
+
+    Many items can be compiled with one compiler invocation using
+    :meth:`batch`.
+    """
+
+    batched = True
+    # Only link the program if the result depends on it
+    link = False
+    prefix = 'program'
     source = '''
-#include <%s>
-int main() { return 0; }
+int main() {
+%s    return 0;
+}
 '''
 
+    def fragment(self, name, args, index):
+        """Return the headers, main body and flags to check an item.
+
+        The index is unique for each item in a batch, and can be used to
+        generate unique identifiers.
+        """
+        return (), '', ()
+
+    def parts(self, items):
+        """Return the headers, main body and flags of a program."""
+        headers = []
+        body = ''
+        seen = []
+        flags = ()
+        for index, (name, args) in enumerate(items):
+            item_headers, item_body, item_flags = self.fragment(
+                name, args, index)
+            for header in item_headers:
+                if header not in headers:
+                    headers.append(header)
+            body += item_body
+            # Flags can take values, such as -I dir, so only skip the flags
+            # of an item if another item had exactly the same flags
+            item_flags = tuple(item_flags)
+            if item_flags not in seen:
+                seen.append(item_flags)
+                flags += item_flags
+        return headers, body, flags
+
+    def program(self, items):
+        headers, body, flags = self.parts(items)
+        source = ''
+        for header in headers:
+            source += '#include <%s>\n' % (header,)
+        source += self.source % (body,)
+        return source, flags
+
+    def batch(self, items):
+        """Check all items with one compiler invocation.
+
+        Every item is compiled as its own translation unit, with only its own
+        headers and flags, so an item can't pass because of another item.
+        Programs that have to be linked are checked one at a time.
+        """
+        if len(items) == 1 or self.link or not syntax_only(self.compiler()):
+            return [self(name, args) for name, args in items]
+
+        # Only units with the same flags can share an invocation
+        groups = collections.OrderedDict()
+        for index, item in enumerate(items):
+            source, flags = self.prepare([item])
+            groups.setdefault(flags, []).append((index, source))
+
+        results = [False] * len(items)
+        for flags, units in groups.items():
+            indexes = [index for index, _ in units]
+            sources = [source for _, source in units]
+            for index, result in zip(indexes, self.units(sources, flags)):
+                results[index] = result
+        return results
+
+    def units(self, sources, flags):
+        """Compile translation units at once, bisect them if they fail."""
+        if len(sources) == 1:
+            return [self.compile(sources[0], flags, link=False,
+                prefix=self.prefix)]
+
+        scratch = self.stage.scratch
+        inputs = ()
+        for source in sources:
+            filename = scratch.filename(self.prefix, '.c')
+            scratch.save(filename, source)
+            self.output.write('script: %s\n%s\n' % (filename, source),
+                detail=True)
+            inputs += (filename,)
+
+        result = self.build(inputs, flags, link=False)
+        if result or not scratch.keep:
+            for filename in inputs:
+                scratch.remove(filename)
+        if result:
+            return [True] * len(sources)
+
+        half = len(sources) // 2
+        return (self.units(sources[:half], flags)
+            + self.units(sources[half:], flags))
+
+    def fingerprint(self, name, args=()):
+        source, flags = self.program([(name, args)])
+        return [
+            toolchain(self.compiler(), self.env.get('PATH')),
+            self.flags(flags),
+            self.link,
+            source,
+        ]
+
+    def inputs(self, name, args=()):
+        return [which(self.compiler(), self.env.get('PATH'))]
+
+    def prepare(self, items):
+        """Return the source and flags of a program, with the headers
+        precompiled if other probes include the same headers."""
+        precompiled = getattr(self.stage, 'precompiled', None)
+        if precompiled is not None:
+            headers, body, flags = self.parts(items)
+            header = precompiled.get(self, headers, flags)
+            if header is not None:
+                self.output.write('precompiled: {} for {}\n'.format(
+                    header, ', '.join(headers)))
+                return self.source % (body,), flags + ('-include', header)
+
+        return self.program(items)
+
+    def probe(self, items):
+        source, flags = self.prepare(items)
+        return self.compile(source, flags, link=self.link, prefix=self.prefix)
+
     def __call__(self, name, args=()):
-        source = self.source % (name,)
-        with TempFile('header', '.c', content=source) as temp:
-            return super(CheckHeader, self).__call__(temp.filename, args)
+        return self.probe([(name, args)])
+
+
+class CheckHeader(CheckProgram):
+    order = 200
+    prefix = 'header'
+
+    def fragment(self, name, args, index):
+        # Extra arguments are passed to the compiler, as for a single probe
+        return (name,), '', tuple(args)
 
 
-class CheckLibrary(CheckCompile):
+class CheckLibrary(CheckProgram):
+    # Every library is linked into its own program
+    batched = False
+    link = True
     order = 500
-    source = '''
-int main() {
-    return 0;
-}
-'''
+    prefix = 'library'
 
     def have(self, what, success):
         return super(CheckLibrary, self).have('lib' + what, success)
 
-    def __call__(self, name, headers=()):
-        source = ''
-        for header in headers:
-            source += '#include <%s>\n' % (header,)
-        source += self.source
-        with TempFile('library', '.c', content=source) as temp:
-            args = ('-l' + name,)
-            return super(CheckLibrary, self).__call__(temp.filename, args)
+    def produces(self, name, args):
+        return ['HAVE_' + self.env_key('lib' + name)]
+
+    def fragment(self, name, headers, index):
+        return headers, '', ('-l' + name,)
 
 
-class CheckType(CheckCompile):
+class CheckType(CheckProgram):
     """Check for type.
 
     Example::
@@ -118,24 +542,16 @@ class CheckType(CheckCompile):
     """
 
     order = 300
-    source = '''
-int main() {
-    %(ctype)s check_type_test;
-    return 0;
-}
+    prefix = 'type'
+    fragment_source = '''    %(ctype)s check_type_test_%(index)d;
 '''
 
-    def __call__(self, ctype, headers=()):
-        source = ''
-        for header in headers:
-            source += '#include <%s>\n' % (header,)
-        source += self.source % {'ctype': ctype}
-        with TempFile('type', '.c', content=source) as temp:
-            args = ('-Wno-unused-variable',)
-            return super(CheckType, self).__call__(temp.filename, args)
+    def fragment(self, ctype, headers, index):
+        body = self.fragment_source % {'ctype': ctype, 'index': index}
+        return headers, body, ('-Wno-unused-variable',)
 
 
-class CheckMember(CheckCompile):
+class CheckMember(CheckProgram):
     """Check for type members, such as structs.
 
     Example::
@@ -145,29 +561,268 @@ class CheckMember(CheckCompile):
     """
 
     order = 350
-    source = '''
-int main() {
-    %(ctype)s check_type_test;
-    (void)check_type_test.%(member)s;
-    return 0;
-}
+    prefix = 'type'
+    fragment_source = '''    %(ctype)s check_type_test_%(index)d;
+    (void)check_type_test_%(index)d.%(member)s;
 '''
 
-    def __call__(self, ctype_with_member, headers=()):
-        attr = {}
+    def fragment(self, ctype_with_member, headers, index):
+        attr = {'index': index}
         attr['ctype'], attr['member'] = ctype_with_member.split('.', 1)
+        body = self.fragment_source % attr
+        return headers, body, ('-Wno-unused-variable',)
+
+
+class CheckValue(CheckProgram):
+    """Base for checks that compute integer constants at compile time.
+
+    The values of items with the same headers are compiled into marked
+    character arrays, and read back from the object file, so no programs
+    have to be executed and many items are resolved with a single compile.
+    If the object file can't be read, as with link time optimization, the
+    value of each item is found by bisection with static assertions instead.
+
+    The value is exported as the env key, followed by the name of the item.
+    """
+
+    always_batch = True
+    fragment_source = '''%(declare)sconst char wright_value_%(index)d[] = {
+    '@', 'w', 'r', 'i', 'g', 'h', 't', ':', %(digits)s, 0
+};
+'''
+    key = None
+    # Largest value that can be determined
+    limit = 1 << 31
+    source = '%s'
+
+    def declare(self, name, index):
+        """Declarations used by the expression of an item."""
+        return ''
+
+    def expression(self, name, index):
+        """The integer constant expression of an item, implemented by the
+        subclasses.
+
+        The expression may use the declarations of the item, and has to be
+        valid at file scope, after including the headers of the item.
+        """
+        raise NotImplementedError(
+            '{} has no expression'.format(type(self).__name__))
+
+    def fragment(self, name, headers, index):
+        expression = '(unsigned long)(%s)' % (self.expression(name, index),)
+        digits = ["'%s'" % (digit,) for digit in '%04d:' % (index,)]
+        for power in range(9, -1, -1):
+            digits.append("(char)('0' + %s / %dUL %% 10)" % (
+                expression, 10 ** power))
+        body = self.fragment_source % {
+            'declare': self.declare(name, index),
+            'digits': ', '.join(digits),
+            'index': index,
+        }
+        return headers, body, ()
+
+    def have(self, name, value):
+        self.env[self.key + self.env_key(name)] = int(value or 0)
+        return bool(value)
+
+    def produces(self, name, args):
+        return [self.key + self.env_key(name)]
+
+    def describe(self, value):
+        return str(value)
+
+    def values(self, items):
+        """Return the values of the items, or None if they don't compile.
+
+        Values that can't be found in the object file are None.
+        """
+        source, flags = self.prepare(items)
+        data = self.object(source, flags, prefix=self.prefix)
+        if data is None:
+            return None
+
+        found = {}
+        for match in RE_VALUE.finditer(data):
+            found[int(match.group(1))] = int(match.group(2))
+        self.output.write('values: {}\n'.format(
+            ', '.join(str(found.get(index)) for index in range(len(items)))))
+        return [found.get(index) for index in range(len(items))]
+
+    def bisect(self, name, args):
+        """Find the value of an item with static assertions."""
+        headers, _, flags = self.fragment(name, args, 0)
         source = ''
         for header in headers:
             source += '#include <%s>\n' % (header,)
-        source += self.source % attr
-        with TempFile('type', '.c', content=source) as temp:
-            args = ('-Wno-unused-variable',)
-            return super(CheckMember, self).__call__(temp.filename, args)
+        source += self.declare(name, 0)
+        source += 'typedef char wright_assert[(unsigned long)(%s) <= %%dUL ' \
+            '? 1 : -1];\n' % (self.expression(name, 0),)
+
+        def within(value):
+            return self.compile(source % (value,), flags, link=False,
+                prefix=self.prefix)
+
+        if not within(self.limit):
+            return False
+        low, high = 0, 1
+        while not within(high):
+            low, high = high, high * 2
+        while high - low > 1:
+            middle = (low + high) // 2
+            if within(middle):
+                high = middle
+            else:
+                low = middle
+        return high
+
+    def batch(self, items):
+        """Read the values of the items with the same headers and flags from
+        one object file, so an item only sees its own headers."""
+        groups = collections.OrderedDict()
+        for index, (name, args) in enumerate(items):
+            headers, _, flags = self.fragment(name, args, index)
+            groups.setdefault((tuple(headers), flags), []).append(index)
+
+        results = [False] * len(items)
+        for indexes in groups.values():
+            values = self.resolve([items[index] for index in indexes])
+            for index, value in zip(indexes, values):
+                results[index] = value
+        return results
+
+    def resolve(self, items):
+        """Read all values from one object file, bisect the items if they
+        don't compile."""
+        values = self.values(items)
+        if values is None:
+            if len(items) == 1:
+                return [False]
+            half = len(items) // 2
+            return self.resolve(items[:half]) + self.resolve(items[half:])
+
+        return [
+            self.bisect(*item) if value is None else value
+            for item, value in zip(items, values)
+        ]
+
+    def __call__(self, name, args=()):
+        return self.batch([(name, args)])[0]
+
+
+class CheckSizeof(CheckValue):
+    """Determine the size of types, exported as ``SIZEOF_<TYPE>``.
+
+    Example::
+
+        [c:sizeof]
+        required =
+            int
+            void *
+        optional =
+            struct tm: time.h
+    """
+
+    key = 'SIZEOF_'
+    order = 400
+    prefix = 'sizeof'
+
+    def env_key(self, item):
+        # Pointers, like void *, are exported as VOID_P
+        return super(CheckSizeof, self).env_key(item.replace('*', 'p'))
+
+    def expression(self, ctype, index):
+        return 'sizeof(%s)' % (ctype,)
+
+
+class CheckAlignof(CheckSizeof):
+    """Determine the alignment of types, exported as ``ALIGNOF_<TYPE>``.
+
+    Example::
+
+        [c:alignof]
+        required =
+            double
+            long long
+    """
+
+    key = 'ALIGNOF_'
+    order = 410
+    prefix = 'alignof'
+
+    def declare(self, ctype, index):
+        return 'struct wright_align_%d { char c; %s x; };\n' % (index, ctype)
+
+    def expression(self, ctype, index):
+        return 'offsetof(struct wright_align_%d, x)' % (index,)
+
+    def fragment(self, ctype, headers, index):
+        headers, body, flags = super(CheckAlignof, self).fragment(
+            ctype, headers, index)
+        return ('stddef.h',) + tuple(headers), body, flags
+
+
+class CheckEndian(CheckCompile):
+    """Determine the byte order from the object file, without running it.
+
+    The byte order is exported as ``BYTE_ORDER`` (big or little) and
+    ``WORDS_BIGENDIAN``.
+
+    Example::
+
+        [c:endian]
+        required = byte order
+    """
+
+    order = 420
+    prefix = 'endian'
+    source = '''short wright_big_endian[] = {
+    0x4249, 0x4765, 0x6E44, 0x6961, 0x6E53, 0x7953, 0
+};
+short wright_little_endian[] = {
+    0x694C, 0x5454, 0x656C, 0x6E45, 0x6944, 0x6E61, 0
+};
+'''
+
+    def fingerprint(self, name, args=()):
+        return [
+            toolchain(self.compiler(), self.env.get('PATH')),
+            self.flags(args),
+            self.source,
+        ]
+
+    def inputs(self, name, args=()):
+        return [which(self.compiler(), self.env.get('PATH'))]
+
+    def have(self, name, order):
+        if order:
+            self.env['BYTE_ORDER'] = order
+            self.env['WORDS_BIGENDIAN'] = order == 'big'
+        return bool(order)
+
+    def produces(self, name, args):
+        return ['BYTE_ORDER', 'WORDS_BIGENDIAN']
+
+    def describe(self, order):
+        return order
+
+    def __call__(self, name, args=()):
+        data = self.object(self.source, args, prefix=self.prefix)
+        if data is None:
+            return False
+        big = b'BIGenDianSyS' in data
+        little = b'LiTTleEnDian' in data
+        if big == little:
+            self.output.write('byte order: unknown\n')
+            return False
+        return 'big' if big else 'little'
 
 
 class C(Stage):
     def __init__(self, *args, **kwargs):
         super(C, self).__init__(*args, **kwargs)
+        # Shared by all checks, they often include the same headers
+        self.precompiled = PrecompiledHeaders()
         self._check = {
             'env':     CheckEnv(self),
             'compile': CheckCompile(self),
@@ -177,4 +832,7 @@ class C(Stage):
             'library': CheckLibrary(self),
             'type':    CheckType(self),
             'member':  CheckMember(self),
+            'sizeof':  CheckSizeof(self),
+            'alignof': CheckAlignof(self),
+            'endian':  CheckEndian(self),
         }
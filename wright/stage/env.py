@@ -1,30 +1,122 @@
+import glob
 import os
+import re
 import shlex
+import string
 import subprocess
 
-from jinja2 import Environment, FileSystemLoader, TemplateNotFound
-
 from .base import Check, CheckExec, CheckExecOutput, Stage
-from ..util import parse_flags
+from ..trace import Span
+from ..util import (FLAG_KEYS, digest, file_identity, parse_flags,
+    path_index, plain, read_file, which, write_if_changed)
+
+# Env keys in format strings, like {env[CC]}
+RE_ENV_FIELD = re.compile(r'^env\[(\w+)\]')
+# Options of pkg-config that only select what is printed, commands with
+# only these options can be combined
+PKG_CONFIG_OUTPUTS = ('--cflags', '--cflags-only-I', '--cflags-only-other',
+    '--libs', '--libs-only-L', '--libs-only-l', '--libs-only-other')
+# Default search path of pkg-config
+PKG_CONFIG_DIRS = (
+    '/usr/lib/pkgconfig',
+    '/usr/lib/*/pkgconfig',
+    '/usr/lib64/pkgconfig',
+    '/usr/share/pkgconfig',
+    '/usr/local/lib/pkgconfig',
+    '/usr/local/share/pkgconfig',
+)
 
 
 class CheckWhich(CheckExec):
-    cache = False
     order = 10
+    parallel = True
+
+    def fingerprint(self, binary, args=()):
+        # The directory mtimes change if binaries are added or removed
+        return path_index(self.env['PATH']).mtimes()
+
+    def inputs(self, binary, args=()):
+        # Binaries are added or removed in any of the directories
+        return path_index(self.env['PATH']).directories
+
+    def consumes(self, binary, args=()):
+        return ['PATH']
+
+    def produces(self, binary, args=()):
+        return ['HAVE_' + self.env_key(binary)]
 
     def __call__(self, binary, args=()):
-        for path in self.env['PATH'].split(':'):
-            full = os.path.join(path, binary)
-            if os.access(full, os.X_OK):
-                return super(CheckWhich, self).__call__((full,) + args)
+        full = path_index(self.env['PATH']).which(binary)
+        if full is None:
+            return False
+
+        return super(CheckWhich, self).__call__((full,) + args)
+
+
+class TrackedEnv(object):
+    """Environment wrapper that records the keys read by a template.
+
+    Reading all items is recorded as a read of the "*" key.
+    """
+
+    def __init__(self, env, reads):
+        self.env = env
+        self.reads = reads
+
+    def __contains__(self, key):
+        self.reads.add(key)
+        return key in self.env
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __getitem__(self, key):
+        self.reads.add(key)
+        return self.env[key]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        self.reads.add('*')
+        return len(self.env)
+
+    def get(self, key, default=None):
+        self.reads.add(key)
+        return self.env.get(key, default)
+
+    def items(self):
+        self.reads.add('*')
+        return list(self.env.items())
 
-        return False
+    def keys(self):
+        self.reads.add('*')
+        return list(self.env.keys())
+
+    def values(self):
+        self.reads.add('*')
+        return list(self.env.values())
 
 
 class Generate(Check):
+    """Generate files from templates.
+
+    For every target the environment keys and templates read while
+    rendering are recorded in the cache; a target is only generated again if
+    any of them changed.
+    """
+
     cache = False
     order = 999
 
+    def __init__(self, stage):
+        super(Generate, self).__init__(stage)
+        self._reads = None
+        self._templates = None
+
     def have(self, *args, **kwargs):
         """Do not export any HAVE_* variables."""
         pass
@@ -39,10 +131,12 @@ class Generate(Check):
             {% if have('netinet/ip.h') %}...{% endif %}
         """
         if name is None:
+            self._track('HAVE_*')
             return (
                 (k, v) for k, v  in self.env.items()
                 if k.startswith('HAVE_')
             )
+        self._track('HAVE_' + self.env_key(name))
         return self.env.get('HAVE_' + self.env_key(name)) == True
 
     def _lib(self, name, only_if_have=False):
@@ -57,6 +151,7 @@ class Generate(Check):
         """
         emit = True
         if only_if_have:
+            self._track('HAVE_LIB' + self.env_key(name))
             emit = self.env.get('HAVE_LIB' + self.env_key(name))
         if emit:
             return '-l' + name
@@ -72,56 +167,305 @@ class Generate(Check):
             {% if with('foo') %}...{% endif %}
         """
         if option is None:
+            self._track('WITH_*')
             return (
                 (k, v) for k, v in self.env.items()
                 if k.startswith('WITH_')
             )
+        self._track('WITH_' + option.upper())
         return self.env.get('WITH_' + option.upper()) == True
 
+    def _track(self, key):
+        if self._reads is not None:
+            self._reads.add(key)
+
+    def dependencies(self, source):
+        """Return the templates and variables used by a template.
+
+        Included templates are followed, returns None if a template includes
+        templates with a dynamic name.
+        """
+        from jinja2 import meta
+
+        templates = self.templates()
+        names = []
+        variables = set()
+        pending = [source]
+        while pending:
+            name = pending.pop()
+            if name in names:
+                continue
+            names.append(name)
+            ast = templates.parse(templates.loader.get_source(templates, name)[0])
+            variables |= meta.find_undeclared_variables(ast)
+            for reference in meta.find_referenced_templates(ast):
+                if reference is None:
+                    return None
+                pending.append(reference)
+
+        variables -= set(templates.globals)
+        variables.discard('env')
+        return names, variables
+
+    def inputs(self, keys):
+        """Digests of the environment keys, keys ending in * match a prefix."""
+        inputs = {}
+        for key in keys:
+            if key.endswith('*'):
+                value = sorted(
+                    [name, plain(value)] for name, value in self.env.items()
+                    if name.startswith(key[:-1])
+                )
+            else:
+                value = plain(self.env.get(key))
+            inputs[key] = digest(value)
+        return inputs
+
+    def analyzed(self, record):
+        """Return the templates and variables of a record, if none of its
+        templates changed, so they don't have to be parsed again."""
+        if not record or 'variables' not in record:
+            return None
+        if not self.unchanged(record):
+            return None
+        return list(record['templates']), set(record['variables'])
+
+    def unchanged(self, record):
+        """Check if none of the recorded templates changed."""
+        for name, template in record['templates'].items():
+            if digest(read_file(name)) != template:
+                return False
+        return True
+
+    def up_to_date(self, target, record):
+        """Check if none of the recorded inputs of a target changed."""
+        if not record or record['target'] != file_identity(target):
+            return False
+        if not self.unchanged(record):
+            return False
+        return self.inputs(record['inputs']) == record['inputs']
+
+    def templates(self):
+        """Return the template environment, it is created once per run.
+
+        Compiled templates are stored next to the cache, so templates that
+        did not change are not parsed and compiled again.
+        """
+        if self._templates is not None:
+            return self._templates
+
+        # Jinja2 takes a while to import, only do so if anything is rendered
+        from jinja2 import (Environment, FileSystemBytecodeCache,
+            FileSystemLoader)
+
+        bytecode_cache = None
+        cache = self.env.get('CACHE')
+        if cache and self.stage.config.getboolean('cache', 'enabled', True):
+            directory = cache + '.templates'
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            bytecode_cache = FileSystemBytecodeCache(directory)
+
+        self._templates = Environment(
+            loader=FileSystemLoader('.'),
+            bytecode_cache=bytecode_cache,
+        )
+        self._templates.globals['have'] = self._have
+        self._templates.globals['lib'] = self._lib
+        self._templates.globals['with'] = self._with
+        return self._templates
+
     def __call__(self, target, source):
+        with Span('generate', target, source=source) as attrs:
+            attrs['result'] = self.render(target, source)
+        return attrs['result']
+
+    def render(self, target, source):
+        """Render the template source to target, if its inputs changed."""
         self.output.write('generate: {} from {}\n'.format(target, source))
-        env = Environment(loader=FileSystemLoader('.'))
-        env.globals['have'] = self._have
-        env.globals['lib'] = self._lib
-        env.globals['with'] = self._with
+        cache_key = (self.stage.name, 'generate', target, source)
+        record = self.stage.cache.get(cache_key)
+        if self.up_to_date(target, record):
+            self.output.write('generate: {} up to date\n'.format(target))
+            return True
+
+        from jinja2 import TemplateNotFound
+
         try:
-            out = env.get_template(source).render(env=self.env, **self.env)
+            template = self.templates().get_template(source)
+            dependencies = self.analyzed(record)
+            if dependencies is None:
+                dependencies = self.dependencies(source)
         except TemplateNotFound as error:
-            self.output.write('error: {} not found\n'.format(source))
+            self.output.write('error: {} not found\n'.format(error.name))
             return False
 
-        with open(target, 'w') as fp:
-            fp.write(out)
+        # Stream the output, so large files are never held in memory
+        self._reads = reads = set()
+        try:
+            stream = template.generate(
+                env=TrackedEnv(self.env, reads), **self.env)
+            if not write_if_changed(target, stream):
+                self.output.write('generate: {} unchanged\n'.format(target))
+        finally:
+            self._reads = None
+
+        if dependencies is None:
+            self.stage.cache.pop(cache_key, None)
+        else:
+            names, variables = dependencies
+            self.stage.cache[cache_key] = {
+                'target': file_identity(target),
+                'templates': dict(
+                    (name, digest(read_file(name))) for name in names
+                ),
+                'inputs': self.inputs(reads | variables),
+                'variables': sorted(variables),
+            }
         return True
 
 
 class Flags(CheckExecOutput):
-    cache = False
+    """Merge compiler flags from the output of commands, like pkg-config.
+
+    pkg-config commands for the same packages, that only select what is
+    printed, are combined into a single invocation, so ``pkg-config --cflags
+    talloc`` and ``pkg-config --libs talloc`` run as ``pkg-config --cflags
+    --libs talloc``. Other commands, like queries with ``--exists`` or
+    ``--atleast-version``, run on their own.
+
+    Example::
+
+        [env:flags]
+        optional =
+            talloc: pkg-config --cflags talloc, pkg-config --libs talloc
+    """
+
     order = 20
 
-    def __call__(self, name, args):
+    def combinable(self, command, options):
+        """Check if a command only selects the output of pkg-config."""
+        return os.path.basename(command[0]).endswith('pkg-config') \
+            and bool(options) \
+            and all(option in PKG_CONFIG_OUTPUTS for option in options)
+
+    def group(self, commands):
+        """Combine the options of pkg-config commands for the same packages.
+
+        Returns a list of (combined command, original commands).
+        """
+        groups = []
+        for command in commands:
+            command = tuple(shlex.split(command))
+            options = [arg for arg in command[1:] if arg.startswith('-')]
+            operands = [arg for arg in command[1:] if not arg.startswith('-')]
+            if not self.combinable(command, options):
+                groups.append((command[0], None, command[1:], [command]))
+                continue
+            for tool, tool_options, tool_operands, originals in groups:
+                if tool == command[0] and tool_options is not None \
+                        and tool_operands == operands:
+                    for option in options:
+                        if option not in tool_options:
+                            tool_options.append(option)
+                    originals.append(command)
+                    break
+            else:
+                groups.append((command[0], options, operands, [command]))
+
+        return [
+            ((tool,) + tuple(options or ()) + tuple(operands), originals)
+            for tool, options, operands, originals in groups
+        ]
+
+    def fingerprint(self, name, args):
+        path = self.env.get('PATH')
+        fingerprint = [
+            (key, value) for key, value in sorted(self.env.items())
+            if key.startswith('PKG_CONFIG')
+        ]
+        for command in args:
+            command = shlex.split(command)
+            full = which(command[0], path)
+            fingerprint.append(full and file_identity(full))
+            if os.path.basename(command[0]).endswith('pkg-config'):
+                fingerprint.extend(
+                    file_identity(filename)
+                    for filename in self._pkg_config_files(command[1:]))
+        return fingerprint
+
+    def inputs(self, name, args):
+        path = self.env.get('PATH')
+        inputs = []
         for command in args:
-            run_args = tuple(shlex.split(command))
-            output = super(Flags, self).__call__(run_args)
+            command = shlex.split(command)
+            inputs.append(which(command[0], path))
+            if os.path.basename(command[0]).endswith('pkg-config'):
+                inputs.extend(self._pkg_config_files(command[1:]))
+        return inputs
+
+    def consumes(self, name, args):
+        return ['PATH', 'PKG_CONFIG_LIBDIR', 'PKG_CONFIG_PATH']
+
+    def produces(self, name, args):
+        return ['HAVE_' + self.env_key(name)] + list(FLAG_KEYS)
+
+    def _pkg_config_files(self, args):
+        """The pkg-config directories and package files."""
+        directories = []
+        for key in ('PKG_CONFIG_PATH', 'PKG_CONFIG_LIBDIR'):
+            directories.extend(self.env.get(key, '').split(os.pathsep))
+        for pattern in PKG_CONFIG_DIRS:
+            directories.extend(sorted(glob.glob(pattern)))
+
+        files = []
+        for directory in directories:
+            if not directory or not os.path.isdir(directory):
+                continue
+            files.append(directory)
+            for package in args:
+                if not package.startswith('-'):
+                    filename = os.path.join(directory, package + '.pc')
+                    if os.path.isfile(filename):
+                        files.append(filename)
+        return files
+
+    def restore(self, name, outputs):
+        if outputs is True:
+            # There were no commands
+            return
+        for output in outputs:
+            self.env.merge(parse_flags(output))
+
+    def __call__(self, name, args):
+        outputs = []
+        for command, _ in self.group(args):
+            output = super(Flags, self).__call__(command)
             if output is None:
                 return False
+            outputs.append(output.strip())
 
-            output = output.strip()
-            if output:
-                self.env.merge(parse_flags(output))
-
-        return True
+        outputs = [output for output in outputs if output]
+        self.restore(name, outputs)
+        return outputs or True
 
 
 class Set(Check):
     cache = False
     order = 10
+    pure = True
     quiet = True
 
     def have(self, *args, **kwargs):
         """Do not export any HAVE_* variables."""
         pass
 
+    def consumes(self, key, value):
+        return []
+
+    def produces(self, key, value):
+        return [key]
+
     def __call__(self, key, value):
         self.env[key] = ' '.join(value)
         return True
@@ -191,10 +535,8 @@ class Env(Stage):
 
     def run(self, check):
         if check == 'generate':
-            source_fmt = self.config.get('env:generate', 'source')
-            for target in self.config.getlist('env:generate', 'target'):
+            for target, source in self._targets():
                 self.echo('generating ' + target + '...')
-                source = source_fmt.format(target=target, env=self.env)
                 if self['generate'](target, source):
                     self.echo_result('done', color='green')
                 else:
@@ -217,3 +559,87 @@ class Env(Stage):
             return True
         else:
             return super(Env, self).run(check)
+
+    def _targets(self):
+        source_fmt = self.config.get('env:generate', 'source')
+        for target in self.config.getlist('env:generate', 'target'):
+            yield target, source_fmt.format(target=target, env=self.env)
+
+    def inputs(self, check):
+        if check == 'generate':
+            inputs = []
+            for target, source in self._targets():
+                record = self.cache.get((self.name, 'generate', target, source))
+                if record:
+                    inputs.extend(sorted(record['templates']))
+                else:
+                    inputs.append(source)
+            return inputs
+        elif check == 'versions':
+            return self.config.getlist('env:versions', 'source')
+        return super(Env, self).inputs(check)
+
+    def outputs(self, check):
+        if check == 'generate':
+            return [target for target, _ in self._targets()]
+        return super(Env, self).outputs(check)
+
+    def environ(self, check):
+        if check == 'generate':
+            # The keys read by the templates are recorded for every target
+            source_fmt = self.config.get('env:generate', 'source')
+            keys = set()
+            for _, field, _, _ in string.Formatter().parse(source_fmt):
+                keys.update(RE_ENV_FIELD.findall(field or ''))
+            for target, source in self._targets():
+                record = self.cache.get((self.name, 'generate', target, source))
+                if not record:
+                    return None
+                keys.update(record['inputs'])
+            return keys
+        return super(Env, self).environ(check)
+
+    def consumes(self, check):
+        if check == 'generate':
+            # Templates may read any key
+            return None
+        elif check == 'versions':
+            return set()
+        return super(Env, self).consumes(check)
+
+    def produces(self, check):
+        if check == 'versions':
+            return set(['*_VERSION', '*_VERSION_*'])
+        return super(Env, self).produces(check)
+
+    def plan(self, check, changed=()):
+        entry = {
+            'stage': self.name,
+            'check': check,
+            'args': [],
+            'optional': False,
+            'condition': None,
+            'estimate': None,
+        }
+        if check == 'generate':
+            for target, source in self._targets():
+                record = self.cache.get((self.name, 'generate', target, source))
+                up_to_date = self['generate'].up_to_date(target, record)
+                yield dict(entry, name=target, args=[source], spawns=False,
+                    state='hit' if up_to_date else 'pending', result=True)
+
+        elif check == 'versions':
+            git = self.config.getboolean('env:versions', 'git', False)
+            for source in self.config.getlist('env:versions', 'source'):
+                if git:
+                    yield dict(entry, name=source, spawns=True,
+                        state='pending')
+                else:
+                    # Only reads the versions file
+                    self['versions'](source, git=False)
+                    yield dict(entry, name=source, spawns=False,
+                        state='apply')
+
+        else:
+            for item in super(Env, self).plan(check, changed):
+                yield item
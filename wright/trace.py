@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+
+# Registered instrumentation hooks
+_hooks = []
+
+
+class Hook(object):
+    """Base class for instrumentation hooks.
+
+    Hooks are called when a span starts and ends, from the thread that runs
+    it. The attributes can be extended until the span ends, for example with
+    the result of a check.
+    """
+
+    def start(self, category, name, attrs):
+        pass
+
+    def end(self, category, name, attrs):
+        pass
+
+
+def register(hook):
+    _hooks.append(hook)
+
+
+def unregister(hook):
+    _hooks.remove(hook)
+
+
+class Span(object):
+    """Context manager around an instrumented piece of work.
+
+    Example::
+
+        with Span('check', 'header', name='stdio.h') as attrs:
+            attrs['result'] = check()
+    """
+
+    def __init__(self, category, name, **attrs):
+        self.category = category
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        for hook in _hooks:
+            hook.start(self.category, self.name, self.attrs)
+        return self.attrs
+
+    def __exit__(self, typ, value, traceback):
+        if typ is not None:
+            self.attrs['error'] = typ.__name__
+        for hook in reversed(_hooks):
+            hook.end(self.category, self.name, self.attrs)
+
+
+class ChromeTrace(Hook):
+    """Exports spans in the Chrome trace event format.
+
+    Each thread becomes a track, so checks that run concurrently are shown
+    next to each other. The trace can be opened in Perfetto or
+    chrome://tracing.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.events = []
+        self.threads = {}
+        self._lock = threading.Lock()
+
+    def _event(self, phase, category, name, attrs=None):
+        now = time.time()
+        thread = threading.current_thread()
+        with self._lock:
+            if thread.ident not in self.threads:
+                self.threads[thread.ident] = len(self.threads) + 1
+                self.events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': os.getpid(),
+                    'tid': self.threads[thread.ident],
+                    'args': {'name': thread.name},
+                })
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': phase,
+                'ts': int(now * 1000000),
+                'pid': os.getpid(),
+                'tid': self.threads[thread.ident],
+            }
+            if attrs:
+                event['args'] = dict(attrs)
+            self.events.append(event)
+
+    def start(self, category, name, attrs):
+        self._event('B', category, name, attrs)
+
+    def end(self, category, name, attrs):
+        self._event('E', category, name, attrs)
+
+    def save(self):
+        with self._lock:
+            events = list(self.events)
+        with open(self.filename, 'w') as fp:
+            json.dump({
+                'traceEvents': events,
+                'displayTimeUnit': 'ms',
+            }, fp, default=str)
@@ -1,7 +1,16 @@
 import collections
+import filecmp
+import functools
+import hashlib
+import io
+import json
+import os
 import re
 import shlex
+import shutil
 import sys
+import tempfile
+import threading
 
 
 if sys.hexversion < 0x03000000:
@@ -66,6 +75,53 @@ class OrderedSet(collections.MutableSet):
         return set(self) == set(other)
 
 
+class PathIndex(object):
+    """Index of the files in the directories of a search path.
+
+    Every directory is listed once, when it is first needed, and stat'ed
+    once for its modification time.
+    """
+
+    def __init__(self, path):
+        self.directories = []
+        for directory in path.split(os.pathsep):
+            if directory and directory not in self.directories:
+                self.directories.append(directory)
+        self._files = {}
+        self._lock = threading.Lock()
+        self._mtimes = None
+
+    def files(self, directory):
+        with self._lock:
+            if directory not in self._files:
+                try:
+                    self._files[directory] = set(os.listdir(directory))
+                except OSError:
+                    self._files[directory] = set()
+            return self._files[directory]
+
+    def mtimes(self):
+        """Modification times of the directories, None if it's missing."""
+        with self._lock:
+            if self._mtimes is None:
+                self._mtimes = []
+                for directory in self.directories:
+                    try:
+                        mtime = os.stat(directory).st_mtime
+                    except OSError:
+                        mtime = None
+                    self._mtimes.append([directory, mtime])
+            return [list(entry) for entry in self._mtimes]
+
+    def which(self, binary):
+        for directory in self.directories:
+            if binary in self.files(directory):
+                full = os.path.join(directory, binary)
+                if os.path.isfile(full) and os.access(full, os.X_OK):
+                    return full
+        return None
+
+
 class Environment(dict):
     defaults = {
         'linux': {
@@ -120,12 +176,33 @@ def camel_case(name):
     return ''.join(name.capitalize().split())
 
 
+def memoize(func):
+    """Remember the results of a function for the rest of the run."""
+    results = {}
+    lock = threading.Lock()
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        with lock:
+            if args not in results:
+                results[args] = func(*args)
+            return results[args]
+
+    return wrapper
+
+
 def normal_case(name):
     """Converts "CamelCaseHere" to "camel case here"."""
     s1 = re.sub(r'(.)([A-Z][a-z]+)', r'\1 \2', name)
     return re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', s1).lower()
 
 
+def digest(*parts):
+    """Stable hex digest of (nested) strings, numbers and sequences."""
+    data = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
 def detect_platform():
     platform = sys.platform
     if platform in ('linux', 'linux2'):
@@ -141,6 +218,16 @@ def detect_platform():
         return platform
 
 
+def file_identity(filename):
+    """Identity of a file: its resolved path, modification time and size."""
+    filename = os.path.realpath(filename)
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return [filename, None, None]
+    return [filename, int(stat.st_mtime), stat.st_size]
+
+
 def import_module(name):
     module = __import__(name)
     for part in name.split('.')[1:]:
@@ -159,20 +246,24 @@ def parse_bool(value, default=True, strict=True):
         return default
 
 
+# Environment keys of the compile flags, as returned by parse_flags
+FLAG_KEYS = (
+    'ASFLAGS',
+    'CFLAGS',
+    'DEFINES',
+    'INCLUDES',
+    'FRAMEWORKS',
+    'FRAMEWORKPATH',
+    'LDFLAGS',
+    'LIBS',
+    'LIBPATH',
+)
+
+
 def parse_flags(*flags, **kwargs):
     """Parse compile flags."""
 
-    parsed = {
-        'ASFLAGS':       OrderedSet(),
-        'CFLAGS':        OrderedSet(),
-        'DEFINES':       OrderedSet(),
-        'INCLUDES':      OrderedSet(),
-        'FRAMEWORKS':    OrderedSet(),
-        'FRAMEWORKPATH': OrderedSet(),
-        'LDFLAGS':       OrderedSet(),
-        'LIBS':          OrderedSet(),
-        'LIBPATH':       OrderedSet(),
-    }
+    parsed = dict((key, OrderedSet()) for key in FLAG_KEYS)
 
     def _parse(arg):
         if not arg:
@@ -284,6 +375,93 @@ def parse_flags(*flags, **kwargs):
     return parsed
 
 
+@memoize
+def path_index(path):
+    """Return the index of a search path, it is built once per run."""
+    return PathIndex(path)
+
+
+def plain(value):
+    """Convert environment values to types that can be digested."""
+    if isinstance(value, (list, tuple, OrderedSet)):
+        return [plain(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((key, plain(item)) for key, item in value.items())
+    elif value is None or isinstance(value, (bool, int, float) + STR_TYPES):
+        return value
+    return repr(value)
+
+
+def read_file(filename):
+    """Read the contents of a file, returns None if it can't be read."""
+    try:
+        with open(filename, 'r') as fp:
+            return fp.read()
+    except (IOError, OSError):
+        return None
+
+
+def uname():
+    """Return the system, node, release, version and machine names."""
+    try:
+        return os.uname()
+    except AttributeError:
+        # os.uname is not available on all supported platforms, platform.uname
+        # is slow because it may run a process to find the processor name
+        import platform
+        return platform.uname()
+
+
+def which(binary, path=None):
+    """Find the full path of an executable, searching path or $PATH."""
+    if os.path.dirname(binary):
+        if os.path.isfile(binary) and os.access(binary, os.X_OK):
+            return binary
+        return None
+
+    if path is None:
+        path = os.environ.get('PATH', '')
+    return path_index(path).which(binary)
+
+
 def yield_from(generate):
     for item in generate:
         yield item
+
+
+def write_if_changed(filename, chunks, encoding='utf-8'):
+    """Write text chunks to a file, only if its contents would change.
+
+    The chunks are written to a temporary file next to the target, which
+    replaces the target atomically. An unchanged target is left untouched,
+    so its modification time is preserved. Returns True if it was written.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp = tempfile.mkstemp(prefix='.wright-', dir=directory)
+    try:
+        with io.open(fd, 'w', encoding=encoding) as fp:
+            for chunk in chunks:
+                fp.write(chunk)
+
+        if os.path.isfile(filename):
+            if filecmp.cmp(temp, filename, shallow=False):
+                os.unlink(temp)
+                return False
+            shutil.copymode(filename, temp)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp, 0o666 & ~umask)
+
+        try:
+            os.rename(temp, filename)
+        except OSError:
+            # Windows doesn't replace existing files
+            os.unlink(filename)
+            os.rename(temp, filename)
+    except:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+
+    return True